@@ -11,6 +11,9 @@ LLM_GEN_CONFIG_DIR = PACKAGE_DIR / "config" / "llm-gen"
 CROWDSOURCING_CONFIG_DIR = PACKAGE_DIR / "config" / "crowdsourcing"
 
 DATA_DIR = PACKAGE_DIR / "data"
+CACHE_DIR = DATA_DIR / ".cache"
+RESPONSE_CACHE_PATH = CACHE_DIR / "llm_responses.sqlite"
+ANNOTATION_INDEX_PATH = CACHE_DIR / "annotation_index.sqlite"
 OUTPUT_DIR = PACKAGE_DIR / "outputs"
 
 RESOURCES_CONFIG_PATH = PACKAGE_DIR / "config" / "resources.yml"
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+import os
+import json
+import logging
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from slugify import slugify
+
+from factgenie import ANNOTATIONS_DIR, ANNOTATION_INDEX_PATH
+
+logger = logging.getLogger(__name__)
+
+
+class AnnotationIndex:
+    """
+    Persistent index of the annotations stored in the JSONL files of the campaigns.
+
+    The records are stored in SQLite together with the number of bytes read from each file, so that only the lines
+    appended since the last update need to be parsed. The records are keyed by (dataset, split, example_idx, setup_id).
+    """
+
+    def __init__(self, path=ANNOTATION_INDEX_PATH, annotations_dir=ANNOTATIONS_DIR):
+        self.path = str(path)
+        self.annotations_dir = str(annotations_dir)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # campaign_id -> (mtime of metadata.json, metadata)
+        self.metadata_cache = {}
+        self.metadata_lock = threading.Lock()
+
+        with self.transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, campaign_id TEXT, offset INTEGER, mtime INTEGER)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS annotations "
+                "(id INTEGER PRIMARY KEY, path TEXT, campaign_id TEXT, dataset TEXT, split TEXT, example_idx INTEGER, "
+                "setup_id TEXT, record TEXT)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_example ON annotations (dataset, split, example_idx, setup_id)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_path ON annotations (path)")
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        try:
+            # the offset of a file is read and updated in the same transaction, so that concurrent updates
+            # do not index the same lines twice
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def get_campaign_files(self):
+        if not os.path.isdir(self.annotations_dir):
+            return
+
+        for campaign_id in os.listdir(self.annotations_dir):
+            files_dir = os.path.join(self.annotations_dir, campaign_id, "files")
+
+            if not os.path.isdir(files_dir):
+                continue
+
+            for filename in os.listdir(files_dir):
+                if filename.endswith(".jsonl"):
+                    yield campaign_id, os.path.join(files_dir, filename)
+
+    def get_file_fingerprints(self):
+        """
+        Return the size and mtime of each indexed file as of its last update.
+        """
+        conn = self.connect()
+        try:
+            return {
+                path: (offset, mtime) for path, offset, mtime in conn.execute("SELECT path, offset, mtime FROM files")
+            }
+        finally:
+            conn.close()
+
+    def sync(self):
+        """
+        Index the lines appended to the annotation files since the last update and drop the removed files.
+        """
+        # the write lock is taken only for the files which changed since the last update
+        fingerprints = self.get_file_fingerprints()
+        paths = set()
+
+        for campaign_id, path in self.get_campaign_files():
+            path = os.path.abspath(path)
+            paths.add(path)
+
+            try:
+                stat = os.stat(path)
+
+                if fingerprints.get(path) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+
+                self.index_file(path, campaign_id=campaign_id)
+            except Exception:
+                logger.exception(f"Error while indexing annotations from {path}")
+
+        removed_paths = [path for path in fingerprints if path not in paths]
+
+        if not removed_paths:
+            return
+
+        with self.transaction() as conn:
+            for path in removed_paths:
+                conn.execute("DELETE FROM annotations WHERE path = ?", (path,))
+                conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def index_file(self, path, campaign_id=None):
+        """
+        Index the lines of the file which were not indexed yet.
+        """
+        path = os.path.abspath(path)
+
+        if campaign_id is None:
+            # the files are stored in `<campaign_id>/files/`
+            campaign_id = os.path.basename(os.path.dirname(os.path.dirname(path)))
+
+        stat = os.stat(path)
+
+        with self.transaction() as conn:
+            row = conn.execute("SELECT offset, mtime FROM files WHERE path = ?", (path,)).fetchone()
+            offset, mtime = row if row is not None else (0, None)
+
+            if mtime == stat.st_mtime_ns and offset == stat.st_size:
+                return
+
+            if stat.st_size < offset:
+                # the file was rewritten, index it from the start
+                conn.execute("DELETE FROM annotations WHERE path = ?", (path,))
+                offset = 0
+
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+
+            # index only the complete lines, the last line may be still being written
+            data = data[: data.rfind(b"\n") + 1]
+            records = []
+
+            for line in data.decode("utf-8").splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    annotation = json.loads(line)
+                    records.append(
+                        (
+                            path,
+                            campaign_id,
+                            slugify(annotation["dataset"]),
+                            slugify(annotation["split"]),
+                            int(annotation["example_idx"]),
+                            slugify(str(annotation["setup_id"])),
+                            line,
+                        )
+                    )
+                except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                    logger.warning(f"Skipping invalid annotation in {path}")
+
+            conn.executemany(
+                "INSERT INTO annotations (path, campaign_id, dataset, split, example_idx, setup_id, record) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                records,
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO files (path, campaign_id, offset, mtime) VALUES (?, ?, ?, ?)",
+                (path, campaign_id, offset + len(data), stat.st_mtime_ns),
+            )
+
+    def get_campaign_metadata(self, campaign_id):
+        metadata_path = os.path.join(self.annotations_dir, campaign_id, "metadata.json")
+
+        try:
+            mtime = os.stat(metadata_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        with self.metadata_lock:
+            cached = self.metadata_cache.get(campaign_id)
+
+            if cached is None or cached[0] != mtime:
+                with open(metadata_path) as f:
+                    cached = (mtime, json.load(f))
+                self.metadata_cache[campaign_id] = cached
+
+        return cached[1]
+
+    def get_annotations(self, dataset_id, split, example_idx, setup_id=None, campaign_id=None, categories=None):
+        """
+        Return the annotations of the example with the metadata of their campaign.
+
+        The annotations can be restricted to the output of `setup_id` and to a single campaign. With `categories`
+        (names or indices of the span categories), only the matching spans are kept in each annotation.
+        """
+        conditions = ["dataset = ?", "split = ?", "example_idx = ?"]
+        params = [slugify(dataset_id), slugify(split), int(example_idx)]
+
+        if setup_id is not None:
+            conditions.append("setup_id = ?")
+            params.append(slugify(setup_id))
+
+        if campaign_id is not None:
+            conditions.append("campaign_id = ?")
+            params.append(campaign_id)
+
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                f"SELECT campaign_id, record FROM annotations WHERE {' AND '.join(conditions)} ORDER BY id", params
+            ).fetchall()
+        finally:
+            conn.close()
+
+        annotations = []
+
+        for campaign_id, record in rows:
+            metadata = self.get_campaign_metadata(campaign_id)
+
+            if metadata is None or metadata["source"] == "hidden":
+                continue
+
+            annotation = json.loads(record)
+            annotation["metadata"] = metadata
+
+            if categories:
+                annotation["annotations"] = filter_spans(annotation.get("annotations", []), metadata, categories)
+
+            annotations.append(annotation)
+
+        return annotations
+
+
+def filter_spans(spans, metadata, categories):
+    span_categories = metadata.get("config", {}).get("annotation_span_categories", [])
+    categories = {str(category) for category in categories}
+    filtered = []
+
+    for span in spans:
+        span_type = span.get("type")
+        name = None
+
+        if isinstance(span_type, int) and 0 <= span_type < len(span_categories):
+            name = span_categories[span_type].get("name")
+
+        if str(span_type) in categories or name in categories:
+            filtered.append(span)
+
+    return filtered
+
+
+annotation_index = None
+annotation_index_lock = threading.Lock()
+
+
+def get_annotation_index():
+    """
+    Return the annotation index shared within the process.
+    """
+    global annotation_index
+
+    with annotation_index_lock:
+        if annotation_index is None:
+            annotation_index = AnnotationIndex()
+
+    return annotation_index
@@ -2,11 +2,17 @@
 import os
 import json
 import glob
+import heapq
 import logging
+import math
+import random
+import sqlite3
+import threading
+import numpy as np
 import pandas as pd
-import ast
 import coloredlogs
 
+from contextlib import contextmanager
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
@@ -28,9 +34,190 @@ class ExampleStatus:
     FREE = "free"
     ASSIGNED = "assigned"
     FINISHED = "finished"
+    # the model failed on the example with an error that is not worth retrying
+    ERROR = "error"
+
+
+class CampaignStorage:
+    CSV = "csv"
+    SQLITE = "sqlite"
+
+
+def to_python_value(value):
+    # the values of the db cells are stored in SQLite and in the JSON journal, which do not support NaN
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if hasattr(value, "item"):
+        # numpy scalars
+        return value.item()
+    return value
+
+
+class SQLiteCampaignDB:
+    """
+    Campaign db stored in SQLite (WAL mode) which can be safely shared by multiple processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        try:
+            # acquire the write lock right away so that concurrent transactions are serialized
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def read(self):
+        conn = self.connect()
+        try:
+            db = pd.read_sql_query("SELECT * FROM db ORDER BY row_idx", conn, index_col="row_idx")
+        finally:
+            conn.close()
+
+        db.index.name = None
+        return db
+
+    def write(self, db):
+        columns = ", ".join(f'"{col}"' for col in db.columns)
+        placeholders = ", ".join(["?"] * (len(db.columns) + 1))
+
+        with self.transaction() as conn:
+            conn.execute("DROP TABLE IF EXISTS db")
+            conn.execute(f"CREATE TABLE db (row_idx INTEGER PRIMARY KEY, {columns})")
+
+            for col in ["status", "batch_idx"]:
+                if col in db.columns:
+                    conn.execute(f'CREATE INDEX idx_{col} ON db ("{col}")')
+
+            conn.executemany(
+                f"INSERT INTO db VALUES ({placeholders})",
+                ([int(i)] + [to_python_value(v) for v in row] for i, row in zip(db.index, db.itertuples(index=False))),
+            )
+
+    def update_rows(self, db, row_idxs, columns):
+        assignments = ", ".join(f'"{col}" = ?' for col in columns)
+
+        with self.transaction() as conn:
+            conn.executemany(
+                f"UPDATE db SET {assignments} WHERE row_idx = ?",
+                ([to_python_value(db.at[i, col]) for col in columns] + [int(i)] for i in row_idxs),
+            )
+
+    def get_batch_rows(self, batch_idx, columns):
+        selected = ", ".join(f'"{col}"' for col in columns)
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                f"SELECT {selected} FROM db WHERE batch_idx = ? ORDER BY row_idx", (int(batch_idx),)
+            ).fetchall()
+        finally:
+            conn.close()
+
+        return [dict(zip(columns, row)) for row in rows]
+
+    def get_status_counts(self, distinct_col=None):
+        count = f'COUNT(DISTINCT "{distinct_col}")' if distinct_col else "COUNT(*)"
+        conn = self.connect()
+        try:
+            rows = conn.execute(f"SELECT status, {count} FROM db GROUP BY status").fetchall()
+        finally:
+            conn.close()
+
+        return dict(rows)
+
+    def assign_batch(self, annotator_id, start, idle_time, seed, update=True):
+        """
+        Select a batch for the annotator and mark it as assigned in a single transaction.
+
+        Returns the batch index or None if there are no batches available.
+        """
+        with self.transaction() as conn:
+            if update:
+                # free the batches which were assigned for too long without being finished
+                conn.execute(
+                    'UPDATE db SET status = ?, start = ?, "end" = ?, annotator_id = ? WHERE status = ? AND start < ?',
+                    (ExampleStatus.FREE, "", "", "", ExampleStatus.ASSIGNED, start - idle_time),
+                )
+
+            free_batches = conn.execute(
+                "SELECT DISTINCT batch_idx FROM db WHERE status = ?", (ExampleStatus.FREE,)
+            ).fetchall()
+
+            if free_batches:
+                batch_idx = random.Random(seed).choice(free_batches)[0]
+            else:
+                # if no free examples but still assigned examples, take the oldest assigned example
+                oldest = conn.execute(
+                    "SELECT batch_idx FROM db WHERE status = ? ORDER BY start LIMIT 1", (ExampleStatus.ASSIGNED,)
+                ).fetchone()
+
+                if oldest is None:
+                    return None
+
+                batch_idx = oldest[0]
+                logger.info(f"Annotating extra batch {batch_idx}")
+
+            if update:
+                conn.execute(
+                    "UPDATE db SET status = ?, start = ?, annotator_id = ? WHERE batch_idx = ?",
+                    (ExampleStatus.ASSIGNED, start, annotator_id, batch_idx),
+                )
+
+        return int(batch_idx)
+
+    def finish_batch(self, batch_idx, end):
+        with self.transaction() as conn:
+            conn.execute(
+                'UPDATE db SET status = ?, "end" = ? WHERE batch_idx = ?', (ExampleStatus.FINISHED, end, batch_idx)
+            )
+
+
+def get_mtimes(campaign_dir, filenames):
+    mtimes = []
+
+    for filename in filenames:
+        try:
+            mtimes.append(os.stat(os.path.join(campaign_dir, filename)).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+
+    return mtimes
+
+
+def get_db_fingerprint(campaign_dir):
+    # the SQLite db is in WAL mode, the committed transactions change `db.sqlite-wal` until they are checkpointed
+    return get_mtimes(campaign_dir, ["db.csv", "db.journal", "db.sqlite", "db.sqlite-wal"])
+
+
+def get_campaign_fingerprint(campaign_dir):
+    """
+    Modification times of the files from which a campaign object is loaded.
+
+    The JSONL files in the "files" subdirectory are not included, they are read incrementally.
+    """
+    return tuple(get_mtimes(campaign_dir, ["metadata.json"]) + get_db_fingerprint(campaign_dir))
 
 
 class Campaign:
+    # columns whose changes are recorded in the journal
+    JOURNAL_COLUMNS = ["status", "start", "end", "annotator_id"]
+    # number of journal entries after which the journal is compacted into `db.csv`
+    JOURNAL_COMPACT_EVERY = 1000
+
     @classmethod
     def get_name(cls):
         return cls.__name__
@@ -43,9 +230,22 @@ class Campaign:
         self.campaign_id = campaign_id
         self.dir = os.path.join(self.__class__.get_main_dir(), campaign_id)
         self.db_path = os.path.join(self.dir, "db.csv")
+        self.journal_path = os.path.join(self.dir, "db.journal")
+        self.journal_size = 0
+        self.sqlite_db = SQLiteCampaignDB(os.path.join(self.dir, "db.sqlite"))
         self.metadata_path = os.path.join(self.dir, "metadata.json")
+        self.stats_path = os.path.join(self.dir, "stats.json")
+
+        self.finished_lock = threading.Lock()
+        self.reset_finished_examples()
+        # serializes writes to the db files (not the in-memory state, which is protected by the campaign lock)
+        self.write_lock = threading.RLock()
+
+        # the db is loaded on first access, listing the campaigns needs only the metadata and the stats
+        self.db_lock = threading.Lock()
+        self._db = None
+        self.stats = None
 
-        self.load_db()
         self.load_metadata()
 
         # temporary fix for the old campaigns
@@ -53,34 +253,239 @@ class Campaign:
             self.metadata["status"] = CampaignStatus.IDLE
             self.update_metadata()
 
-        # if the db does not contain the `end` column, add it
-        if "end" not in self.db.columns:
-            self.db["end"] = ""
-            self.update_db(self.db)
+        self.update_fingerprint()
+
+    @property
+    def db(self):
+        if self._db is None:
+            with self.db_lock:
+                if self._db is None:
+                    self.load_db()
+
+        return self._db
+
+    def update_fingerprint(self):
+        # called after loading and after each write, so that only external changes make the campaign outdated
+        self.db_fingerprint = get_db_fingerprint(self.dir)
+        self.fingerprint = get_campaign_fingerprint(self.dir)
+
+    def invalidate_db(self):
+        """
+        Drop the in-memory db after a write which did not go through it (e.g. the SQLite batch assignment), the db
+        is loaded again on next access.
+        """
+        with self.db_lock:
+            self._db = None
+
+        self.stats = None
+        self.update_fingerprint()
+
+    def is_outdated(self):
+        return self.fingerprint != get_campaign_fingerprint(self.dir)
+
+    def reset_finished_examples(self):
+        self.finished_examples = []
+        # byte offset of the first unread line for each JSONL file in the "files" subdirectory
+        self.finished_offsets = {}
+
+    def read_finished_examples(self):
+        # parse only the lines appended to the JSONL files since the last call
+        jsonl_files = glob.glob(os.path.join(self.dir, "files/*.jsonl"))
+
+        for jsonl_file in jsonl_files:
+            offset = self.finished_offsets.get(jsonl_file, 0)
+            size = os.path.getsize(jsonl_file)
+
+            if size < offset:
+                # the file was rewritten, start over
+                self.reset_finished_examples()
+                return self.read_finished_examples()
+
+            if size == offset:
+                continue
+
+            with open(jsonl_file, "rb") as f:
+                f.seek(offset)
+                data = f.read(size - offset)
+
+            # keep the incomplete last line (if any) for the next call
+            end = data.rfind(b"\n") + 1
+
+            for line in data[:end].splitlines():
+                if line.strip():
+                    self.finished_examples.append(json.loads(line))
+
+            self.finished_offsets[jsonl_file] = offset + end
+
+        if len(jsonl_files) < len(self.finished_offsets):
+            # some files were removed, start over
+            self.reset_finished_examples()
+            return self.read_finished_examples()
 
     def get_finished_examples(self):
-        # load all the JSONL files in the "files" subdirectory
-        examples_finished = []
+        with self.finished_lock:
+            self.read_finished_examples()
+            return list(self.finished_examples)
+
+    def get_finished_count(self):
+        with self.finished_lock:
+            self.read_finished_examples()
+            return len(self.finished_examples)
 
-        for jsonl_file in glob.glob(os.path.join(self.dir, "files/*.jsonl")):
-            with open(jsonl_file) as f:
-                for line in f:
-                    example = json.loads(line)
-                    examples_finished.append(example)
+    @property
+    def storage(self):
+        if os.path.exists(self.sqlite_db.path):
+            return CampaignStorage.SQLITE
 
-        return examples_finished
+        return CampaignStorage.CSV
 
     def update_db(self, db):
-        db.to_csv(self.db_path, index=False)
+        self.stats = None
+
+        if self.storage == CampaignStorage.SQLITE:
+            self.sqlite_db.write(db)
+            self.update_fingerprint()
+            return
+
+        with self.write_lock:
+            # write to a temporary file first so that the db is never left half-written
+            tmp_path = self.db_path + ".tmp"
+            db.to_csv(tmp_path, index=False)
+            os.replace(tmp_path, self.db_path)
+
+            # all the journal entries are now contained in `db.csv`
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+            self.journal_size = 0
+            self.update_fingerprint()
+
+    def update_db_rows(self, db, row_idxs):
+        """
+        Record the status of the given rows in the append-only journal instead of rewriting the whole `db.csv`.
+
+        The journal is compacted into `db.csv` every `JOURNAL_COMPACT_EVERY` entries.
+        """
+        columns = [col for col in self.JOURNAL_COLUMNS if col in db.columns]
+        self.stats = None
+
+        if self.storage == CampaignStorage.SQLITE:
+            # no journal needed, the rows are updated in place
+            self.sqlite_db.update_rows(db, row_idxs, columns)
+            self.update_fingerprint()
+            return
+
+        with self.write_lock:
+            with open(self.journal_path, "a") as f:
+                for i in row_idxs:
+                    entry = {"idx": int(i), **{col: to_python_value(db.at[i, col]) for col in columns}}
+                    f.write(json.dumps(entry) + "\n")
+
+            self.journal_size += len(row_idxs)
+
+            if self.journal_size >= self.JOURNAL_COMPACT_EVERY:
+                self.update_db(db)
+            else:
+                self.update_fingerprint()
+
+    def load_journal(self):
+        entries = []
+
+        if not os.path.exists(self.journal_path):
+            return entries
+
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line may be incomplete if the process was interrupted while writing
+                    logger.warning(f"Skipping invalid journal entry in {self.journal_path}: {line}")
+
+        return entries
 
     def load_db(self):
-        with open(self.db_path) as f:
-            self.db = pd.read_csv(f)
+        # taken before reading, so that the changes made while reading are picked up by the next reload
+        self.db_fingerprint = get_db_fingerprint(self.dir)
+
+        if self.storage == CampaignStorage.SQLITE:
+            db = self.sqlite_db.read()
+        else:
+            with open(self.db_path) as f:
+                db = pd.read_csv(f)
+
+            # replay the status changes which were not compacted into `db.csv` yet
+            entries = self.load_journal()
+            self.journal_size = len(entries)
+
+            if entries:
+                journal = pd.DataFrame.from_records(entries).drop_duplicates("idx", keep="last").set_index("idx")
+
+                for col in journal.columns:
+                    if col not in db.columns:
+                        db[col] = ""
+
+                    # e.g. the timestamps of the journal cannot be assigned to a column of NaNs read from the CSV
+                    dtype = np.result_type(db[col].dtype, journal[col].dtype)
+                    db[col] = db[col].astype(dtype)
+                    db.loc[journal.index, col] = journal[col].astype(dtype).values
+
+        # if the db does not contain the `end` column, add it
+        if "end" not in db.columns:
+            db["end"] = ""
+            self.update_db(db)
+
+        self._db = db
+        self.stats = None
+
+    def reload_shared_db(self):
+        # the in-memory db is up to date unless it is shared with other processes which changed it since it was loaded
+        if self.storage == CampaignStorage.SQLITE and (
+            self._db is None or self.db_fingerprint != get_db_fingerprint(self.dir)
+        ):
+            self.load_db()
+
+    def get_stats(self):
+        """
+        Return the counts of examples for each status.
+
+        The stats are cached in memory and in `stats.json` (along with the mtimes of the db files they were computed
+        from), so that the db does not need to be loaded for listing the campaigns.
+        """
+        if self.stats is None:
+            self.stats = self.load_stats()
+
+        return self.stats
+
+    def load_stats(self):
+        db_fingerprint = get_db_fingerprint(self.dir)
+
+        if self._db is None and os.path.exists(self.stats_path):
+            try:
+                with open(self.stats_path) as f:
+                    summary = json.load(f)
+
+                if summary["fingerprint"] == db_fingerprint:
+                    return summary["stats"]
+            except (json.JSONDecodeError, KeyError):
+                logger.warning(f"Invalid stats summary in {self.stats_path}, recomputing")
+
+        stats = {status: int(count) for status, count in self.compute_stats().items()}
+
+        with open(self.stats_path, "w") as f:
+            json.dump({"fingerprint": db_fingerprint, "stats": stats}, f)
+
+        return stats
+
+    def compute_stats(self):
+        return {}
 
     def update_metadata(self):
         with open(self.metadata_path, "w") as f:
             json.dump(self.metadata, f, indent=4)
 
+        self.update_fingerprint()
+
     def load_metadata(self):
         with open(self.metadata_path) as f:
             self.metadata = json.load(f)
@@ -91,30 +496,225 @@ class ExternalCampaign(Campaign):
         return {}
 
 
+def get_batch_index(db):
+    """
+    Return the positions of the rows of each batch in the db ({batch_idx: array of positions}).
+    """
+    return db.groupby("batch_idx").indices
+
+
+class BatchAssignmentEngine:
+    """
+    In-memory state of the batch assignments of a crowdsourcing campaign.
+
+    Keeps a pool of free batches and a min-heap of leases ordered by their start time, so that assigning a batch and
+    reclaiming idle batches does not require scanning the whole db.
+    """
+
+    def __init__(self, db, idle_time, batch_index=None):
+        self.idle_time = idle_time
+
+        if batch_index is None:
+            batch_index = get_batch_index(db)
+
+        # batch_idx -> row labels of the batch in the db
+        self.batch_rows = {batch_idx: db.index[positions] for batch_idx, positions in batch_index.items()}
+        batches = db.groupby("batch_idx")[["status", "start"]].first()
+
+        # free batches are kept in a list (for random selection) with a position index (for O(1) removal)
+        self.free_batches = []
+        self.free_pos = {}
+        # heap of (start, batch_idx) and the start of the current lease of each assigned batch
+        # (heap entries not matching the current lease are stale and skipped lazily)
+        self.leases = []
+        self.lease_start = {}
+
+        for batch_idx, batch in batches.iterrows():
+            if batch["status"] == ExampleStatus.FREE:
+                self.add_free(batch_idx)
+            elif batch["status"] == ExampleStatus.ASSIGNED:
+                self.add_lease(batch_idx, batch["start"])
+
+    def add_free(self, batch_idx):
+        if batch_idx not in self.free_pos:
+            self.free_pos[batch_idx] = len(self.free_batches)
+            self.free_batches.append(batch_idx)
+
+    def remove_free(self, batch_idx):
+        pos = self.free_pos.pop(batch_idx, None)
+
+        if pos is None:
+            return
+
+        # move the last batch to the freed position
+        last = self.free_batches.pop()
+        if last != batch_idx:
+            self.free_batches[pos] = last
+            self.free_pos[last] = pos
+
+    def add_lease(self, batch_idx, start):
+        self.lease_start[batch_idx] = start
+        heapq.heappush(self.leases, (start, batch_idx))
+
+    def pop_stale_leases(self):
+        while self.leases and self.lease_start.get(self.leases[0][1]) != self.leases[0][0]:
+            heapq.heappop(self.leases)
+
+    def reclaim_idle(self, now):
+        """Free the batches assigned for longer than `idle_time`, return their indices."""
+        freed = []
+        self.pop_stale_leases()
+
+        while self.leases and self.leases[0][0] < now - self.idle_time:
+            _, batch_idx = heapq.heappop(self.leases)
+            del self.lease_start[batch_idx]
+            self.add_free(batch_idx)
+            freed.append(batch_idx)
+
+            self.pop_stale_leases()
+
+        return freed
+
+    def select(self, seed):
+        if self.free_batches:
+            return random.Random(seed).choice(self.free_batches)
+
+        # if no free batches but still assigned batches, take the oldest assigned batch
+        self.pop_stale_leases()
+
+        if self.leases:
+            batch_idx = self.leases[0][1]
+            logger.info(f"Annotating extra batch {batch_idx}")
+            return batch_idx
+
+        return None
+
+    def assign(self, batch_idx, start):
+        self.remove_free(batch_idx)
+        self.add_lease(batch_idx, start)
+
+    def finish(self, batch_idx):
+        self.remove_free(batch_idx)
+        self.lease_start.pop(batch_idx, None)
+
+
 class HumanCampaign(Campaign):
-    def get_examples_for_batch(self, batch_idx):
-        annotator_batch = []
-
-        # find all examples for this batch in self.db
-        batch_examples = self.db[self.db["batch_idx"] == batch_idx]
-
-        for _, row in batch_examples.iterrows():
-            annotator_batch.append(
-                {
-                    "dataset": row["dataset"],
-                    "split": row["split"],
-                    "setup_id": row["setup_id"],
-                    "example_idx": row["example_idx"],
-                    "annotator_group": row["annotator_group"],
-                }
+    BATCH_EXAMPLE_COLUMNS = ["dataset", "split", "setup_id", "example_idx", "annotator_group"]
+
+    def __init__(self, campaign_id):
+        self.assignment_engine = None
+        self.batch_index = None
+        super().__init__(campaign_id)
+
+    def load_db(self):
+        super().load_db()
+
+        # the assignment state and the batch index are rebuilt from the new db when needed
+        self.assignment_engine = None
+        self.batch_index = None
+
+    def get_batch_index(self):
+        db = self.db
+
+        # the batches are fixed when the campaign is created, the index needs to be rebuilt only with a new db
+        if self.batch_index is None:
+            self.batch_index = get_batch_index(db)
+
+        return self.batch_index
+
+    def get_idle_time(self):
+        # time (in seconds) after which an unfinished batch can be re-assigned to a new annotator
+        idle_time = self.metadata.get("config", {}).get("idle_time") or 120
+        return int(idle_time) * 60
+
+    def get_assignment_engine(self):
+        # accessing the db first, loading the db resets the engine
+        db = self.db
+
+        if self.assignment_engine is None:
+            self.assignment_engine = BatchAssignmentEngine(
+                db, idle_time=self.get_idle_time(), batch_index=self.get_batch_index()
             )
-        return annotator_batch
+
+        return self.assignment_engine
+
+    def assign_batch(self, annotator_id, start, seed, update=True):
+        """
+        Select a batch for the annotator and (if `update` is set) mark it as assigned.
+
+        Returns the batch index (None if there are no batches available) and the list of rows of `self.db` which
+        have changed and should be persisted with `update_db_rows`. For the CSV storage, the caller has to hold the
+        campaign lock.
+        """
+        if self.storage == CampaignStorage.SQLITE:
+            batch_idx = self.sqlite_db.assign_batch(annotator_id, start, self.get_idle_time(), seed, update=update)
+
+            if update:
+                self.invalidate_db()
+
+            return batch_idx, []
+
+        engine = self.get_assignment_engine()
+
+        if not update:
+            return engine.select(seed), []
+
+        freed = engine.reclaim_idle(now=start)
+        batch_idx = engine.select(seed)
+
+        if batch_idx is None:
+            return None, []
+
+        engine.assign(batch_idx, start)
+
+        # update only the rows which have changed
+        db = self.db
+        changed_rows = []
+
+        for freed_idx in freed:
+            rows = engine.batch_rows[freed_idx]
+            db.loc[rows, ["status", "start", "end", "annotator_id"]] = [ExampleStatus.FREE, "", "", ""]
+            changed_rows.extend(rows)
+
+        rows = engine.batch_rows[batch_idx]
+        db.loc[rows, ["status", "start", "annotator_id"]] = [ExampleStatus.ASSIGNED, start, annotator_id]
+        changed_rows.extend(rows)
+
+        return int(batch_idx), changed_rows
+
+    def finish_batch(self, batch_idx, end):
+        """
+        Mark the batch as finished, return the list of changed rows (see `assign_batch`).
+        """
+        if self.storage == CampaignStorage.SQLITE:
+            self.sqlite_db.finish_batch(batch_idx, end)
+            self.invalidate_db()
+            return []
+
+        engine = self.get_assignment_engine()
+        engine.finish(batch_idx)
+
+        rows = engine.batch_rows[batch_idx]
+        self.db.loc[rows, ["status", "end"]] = [ExampleStatus.FINISHED, end]
+
+        return list(rows)
+
+    def get_examples_for_batch(self, batch_idx):
+        if self.storage == CampaignStorage.SQLITE:
+            # the in-memory db is dropped with each assignment, the batch is read without loading it again
+            return self.sqlite_db.get_batch_rows(batch_idx, self.BATCH_EXAMPLE_COLUMNS)
+
+        positions = self.get_batch_index().get(batch_idx, [])
+        batch_examples = self.db.iloc[positions]
+
+        return batch_examples[self.BATCH_EXAMPLE_COLUMNS].to_dict(orient="records")
 
     def get_overview(self):
-        self.load_db()
-        overview_db = self.db.copy()
+        self.reload_shared_db()
+        batch_index = self.get_batch_index()
+
         # replace NaN with empty string
-        overview_db = overview_db.where(pd.notnull(overview_db), "")
+        overview_db = self.db.where(pd.notnull(self.db), "")
 
         # group by batch idx
         # add a column with the number of examples for each batch
@@ -133,7 +733,11 @@ class HumanCampaign(Campaign):
             }
         )
 
-        overview_db["example_details"] = overview_db.index.map(lambda batch_idx: self.get_examples_for_batch(batch_idx))
+        # convert all the rows at once and split them into batches with the batch index
+        examples = self.db[self.BATCH_EXAMPLE_COLUMNS].to_dict(orient="records")
+        overview_db["example_details"] = overview_db.index.map(
+            lambda batch_idx: [examples[pos] for pos in batch_index[batch_idx]]
+        )
 
         overview_db = overview_db.rename(columns={"example_idx": "example_cnt"}).reset_index()
         overview_db = overview_db.to_dict(orient="records")
@@ -141,6 +745,13 @@ class HumanCampaign(Campaign):
         return overview_db
 
     def get_stats(self):
+        if self.storage == CampaignStorage.SQLITE:
+            # the db may have been updated by other processes
+            return self.sqlite_db.get_status_counts(distinct_col="batch_idx")
+
+        return super().get_stats()
+
+    def compute_stats(self):
         # group by batch_idx, keep the first row of each group
         batch_stats = self.db.groupby("batch_idx").first()
 
@@ -148,57 +759,81 @@ class HumanCampaign(Campaign):
 
 
 class LLMCampaign(Campaign):
-    def get_stats(self):
+    JOURNAL_COLUMNS = Campaign.JOURNAL_COLUMNS + ["error"]
+    # columns on which the db rows are paired with the finished examples
+    OVERVIEW_KEY = ["dataset", "split", "setup_id", "example_idx"]
+    # the field of the finished examples shown as the output and its value for the examples which are not finished
+    OUTPUT_FIELD = None
+    OUTPUT_DEFAULT = ""
+
+    def load_db(self):
+        super().load_db()
+
+        # the error message of the examples on which the model failed
+        if "error" not in self._db.columns:
+            self._db["error"] = ""
+
+        self._db["error"] = self._db["error"].fillna("")
+
+    def compute_stats(self):
         return self.db["status"].value_counts().to_dict()
 
+    def get_overview(self, offset=0, limit=None):
+        """
+        Return the db rows paired with the outputs of the finished examples.
 
-class LLMCampaignEval(LLMCampaign):
-    def get_overview(self):
-        # pair the examples in db with the finished examples
-        # we need to match the examples on (dataset, split, setup, example_idx)
-        # add the annotations to the df
+        With `limit`, only the rows `offset:offset+limit` are returned.
+        """
+        self.reload_shared_db()
+
+        end = offset + limit if limit is not None else None
+        overview_db = self.db.iloc[offset:end].drop(columns=["output"], errors="ignore")
 
-        # get the finished examples
         finished_examples = self.get_finished_examples()
-        example_index = {
-            (ex["dataset"], ex["split"], ex["setup_id"], ex["example_idx"]): str(ex) for ex in finished_examples
-        }
 
-        self.load_db()
-        overview_db = self.db.copy()
-        overview_db["output"] = ""
+        if not finished_examples:
+            # merging with an empty frame would fail on the mismatched dtypes of the key columns
+            overview_db["output"] = self.OUTPUT_DEFAULT
+            return self.add_errors_to_overview(overview_db).to_dict(orient="records")
 
-        for i, row in self.db.iterrows():
-            key = (row["dataset"], row["split"], row["setup_id"], row["example_idx"])
-            example = ast.literal_eval(example_index.get(key, "{}"))
+        finished_examples = pd.DataFrame.from_records(
+            finished_examples, columns=self.OVERVIEW_KEY + [self.OUTPUT_FIELD]
+        )
+        # the keys are compared as strings, e.g. an all-digit `setup_id` is read from `db.csv` as int but stored as
+        # a string in the JSONL records (the rows of the overview keep their original values)
+        finished_examples[self.OVERVIEW_KEY] = finished_examples[self.OVERVIEW_KEY].astype(str)
+        overview_keys = overview_db[self.OVERVIEW_KEY].astype(str)
+
+        # if an example was saved multiple times, the last record wins
+        finished_examples = finished_examples.drop_duplicates(self.OVERVIEW_KEY, keep="last")
+        finished_examples["output"] = finished_examples[self.OUTPUT_FIELD].map(
+            lambda x: str(x) if isinstance(x, (list, dict, str)) else self.OUTPUT_DEFAULT
+        )
 
-            annotations = example.get("annotations", [])
-            overview_db.at[i, "output"] = str(annotations)
+        outputs = overview_keys.merge(
+            finished_examples[self.OVERVIEW_KEY + ["output"]], on=self.OVERVIEW_KEY, how="left", validate="many_to_one"
+        )
+        overview_db["output"] = outputs["output"].fillna(self.OUTPUT_DEFAULT).values
 
-        overview_db = overview_db.to_dict(orient="records")
+        return self.add_errors_to_overview(overview_db).to_dict(orient="records")
+
+    def add_errors_to_overview(self, overview_db):
+        # the error message is shown in place of the output of the failed examples
+        failed = overview_db["status"] == ExampleStatus.ERROR
+        overview_db.loc[failed, "output"] = overview_db.loc[failed, "error"]
 
         return overview_db
 
 
+class LLMCampaignEval(LLMCampaign):
+    OUTPUT_FIELD = "annotations"
+    OUTPUT_DEFAULT = "[]"
+
+
 class LLMCampaignGen(LLMCampaign):
+    OVERVIEW_KEY = ["dataset", "split", "example_idx"]
+    OUTPUT_FIELD = "out"
+
     @classmethod
     def get_main_dir(cls):
         return GENERATIONS_DIR
-
-    def get_overview(self):
-        finished_examples = self.get_finished_examples()
-
-        example_index = {(ex["dataset"], ex["split"], ex["example_idx"]): str(ex) for ex in finished_examples}
-
-        self.load_db()
-        overview_db = self.db.copy()
-        overview_db["output"] = ""
-
-        for i, row in self.db.iterrows():
-            key = (row["dataset"], row["split"], row["example_idx"])
-            example = ast.literal_eval(example_index.get(key, "{}"))
-
-            overview_db.at[i, "output"] = str(example.get("out", ""))
-
-        overview_db = overview_db.to_dict(orient="records")
-        return overview_db
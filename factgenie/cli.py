@@ -58,7 +58,12 @@ def run_llm_campaign(
 
     model = ModelFactory.from_config(metric_config, mode=mode)
 
-    return utils.run_llm_campaign(mode, campaign_id, announcer, campaign, datasets, model, threads)
+    result = utils.run_llm_campaign(mode, campaign_id, announcer, campaign, datasets, model, threads)
+
+    if not result["success"]:
+        raise click.ClickException(result["error"])
+
+    click.echo(result["final_message"])
 
 
 def create_app(**kwargs):
@@ -88,6 +93,8 @@ def create_app(**kwargs):
     from factgenie import ROOT_DIR, MAIN_CONFIG_PATH, GENERATIONS_DIR, ANNOTATIONS_DIR, DATA_DIR, OUTPUT_DIR
     from factgenie import utils
     from factgenie.utils import check_login, migrate
+    from factgenie.response_cache import get_response_cache
+    from factgenie.annotation_index import get_annotation_index
 
     # --- compatibility with older versions ---
     migrate()
@@ -101,7 +108,13 @@ def create_app(**kwargs):
     os.makedirs(DATA_DIR, exist_ok=True)
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+    # the index is created on the first start, the annotations are indexed with the first sync
+    app.db["annotation_index"] = get_annotation_index()
+
     app.config.update(config)
+    app.db["render_cache"].max_size = config.get("render_cache_size", 1024)
+    get_response_cache().max_size = config.get("response_cache_size_mb", 512) * 1024 * 1024
+    app.db["job_runner"].num_workers = config.get("llm_campaign_workers", 2)
     app.config["root_dir"] = ROOT_DIR
 
     assert check_login(
@@ -109,8 +122,6 @@ def create_app(**kwargs):
     ), "Login should pass for valid user"
     assert not check_login(app, "dummy_non_user_name", "dummy_bad_password"), "Login should fail for dummy user"
 
-    app.db["datasets_obj"] = utils.instantiate_datasets()
-
     if config["debug"] is False:
         logging.getLogger("werkzeug").disabled = True
 
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+import traceback
+
+from factgenie.campaigns import CampaignStatus
+from factgenie.models import ModelFactory
+import factgenie.utils as utils
+
+logger = logging.getLogger(__name__)
+
+
+class JobStatus:
+    QUEUED = "queued"
+    RUNNING = "running"
+    # the job was paused, the examples in flight are still being collected
+    PAUSING = "pausing"
+    PAUSED = "paused"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+# allowed state transitions of the jobs
+JOB_TRANSITIONS = {
+    JobStatus.QUEUED: {JobStatus.RUNNING, JobStatus.PAUSED, JobStatus.CANCELLED},
+    JobStatus.RUNNING: {JobStatus.PAUSING, JobStatus.FINISHED, JobStatus.FAILED, JobStatus.CANCELLED},
+    JobStatus.PAUSING: {JobStatus.PAUSED, JobStatus.QUEUED, JobStatus.CANCELLED},
+    JobStatus.PAUSED: {JobStatus.QUEUED, JobStatus.CANCELLED},
+    JobStatus.FINISHED: set(),
+    JobStatus.FAILED: set(),
+    JobStatus.CANCELLED: set(),
+}
+
+# jobs which still hold their campaign, a campaign can have at most one active job
+ACTIVE_JOB_STATUSES = {JobStatus.QUEUED, JobStatus.RUNNING, JobStatus.PAUSING, JobStatus.PAUSED}
+
+# number of finished, failed or cancelled jobs kept in the registry for each campaign
+MAX_INACTIVE_JOBS_PER_CAMPAIGN = 10
+
+
+class Job:
+    def __init__(self, mode, campaign_id):
+        self.id = uuid.uuid4().hex
+        self.mode = mode
+        self.campaign_id = campaign_id
+        self.status = JobStatus.QUEUED
+        self.created = int(time.time())
+        self.updated = self.created
+        # the final message of the campaign or the error which stopped it
+        self.message = None
+        # the status of the campaign after the last run of the job
+        self.campaign_status = None
+
+    def is_active(self):
+        return self.status in ACTIVE_JOB_STATUSES
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "campaign_id": self.campaign_id,
+            "status": self.status,
+            "created": self.created,
+            "updated": self.updated,
+            "message": self.message,
+            "campaign_status": self.campaign_status,
+        }
+
+
+class JobRunner:
+    """
+    Runs the LLM campaigns in background worker threads, decoupled from the HTTP requests which start them.
+
+    The jobs are kept in an in-memory registry, their state changes are announced to the SSE listeners of the
+    campaign as `job` events. The running campaign is stopped through the `running` flag in `app.db["threads"]`,
+    which `utils.run_llm_campaign()` checks before sending each example to the model.
+    """
+
+    def __init__(self, app, num_workers=2):
+        self.app = app
+        self.num_workers = num_workers
+        self.queue = queue.Queue()
+        self.jobs = {}
+        self.lock = threading.RLock()
+        self.workers = []
+        # a campaign is never run by two workers at once, e.g. when resumed before the paused run has finished
+        self.campaign_locks = {}
+
+    def start_workers(self):
+        with self.lock:
+            while len(self.workers) < self.num_workers:
+                worker = threading.Thread(target=self.work, name=f"job-worker-{len(self.workers)}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def get_campaign_job(self, campaign_id):
+        """
+        Return the active job of the campaign, or `None` if the campaign is not being run.
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                if job.campaign_id == campaign_id and job.is_active():
+                    return job
+
+        return None
+
+    def get_last_campaign_job(self, campaign_id):
+        """
+        Return the most recent job of the campaign (in any state), or `None` if the campaign has no job.
+        """
+        with self.lock:
+            for job in reversed(list(self.jobs.values())):
+                if job.campaign_id == campaign_id:
+                    return job
+
+        return None
+
+    def get_jobs(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def set_running_flag(self, campaign_id, running):
+        self.app.db["threads"].setdefault(campaign_id, {})["running"] = running
+
+    def announce(self, job):
+        announcer = self.app.db["announcers"].get(job.campaign_id)
+
+        if announcer is not None:
+            announcer.announce(msg=utils.format_sse(data=json.dumps(job.to_dict()), event="job"))
+
+    def transition(self, job, status, message=None):
+        with self.lock:
+            if status not in JOB_TRANSITIONS[job.status]:
+                raise ValueError(f"Job {job.id} cannot go from `{job.status}` to `{status}`")
+
+            job.status = status
+            job.updated = int(time.time())
+
+            if message is not None:
+                job.message = message
+
+            logger.info(f"Job {job.id} ({job.campaign_id}): {status}")
+
+            if not job.is_active():
+                self.prune_jobs(job.campaign_id)
+
+        self.announce(job)
+
+    def prune_jobs(self, campaign_id):
+        # the jobs are kept in the order of their creation, only the most recent inactive jobs are kept
+        with self.lock:
+            inactive_jobs = [
+                job for job in self.jobs.values() if job.campaign_id == campaign_id and not job.is_active()
+            ]
+
+            for job in inactive_jobs[:-MAX_INACTIVE_JOBS_PER_CAMPAIGN]:
+                del self.jobs[job.id]
+
+    def submit(self, mode, campaign_id):
+        """
+        Queue the campaign for running and return its job. A paused job of the campaign is resumed instead.
+        """
+        with self.lock:
+            job = self.get_campaign_job(campaign_id)
+
+            if job is not None:
+                if job.status in [JobStatus.PAUSING, JobStatus.PAUSED]:
+                    self.resume(job)
+                return job
+
+            job = Job(mode, campaign_id)
+            self.jobs[job.id] = job
+
+            if campaign_id not in self.app.db["announcers"]:
+                self.app.db["announcers"][campaign_id] = utils.MessageAnnouncer()
+
+        self.start_workers()
+        self.queue.put(job.id)
+
+        return job
+
+    def pause(self, job):
+        # the examples in flight are still collected, the running job is paused once `run_llm_campaign()` returns
+        with self.lock:
+            self.set_running_flag(job.campaign_id, False)
+            self.transition(job, JobStatus.PAUSING if job.status == JobStatus.RUNNING else JobStatus.PAUSED)
+
+    def resume(self, job):
+        self.transition(job, JobStatus.QUEUED)
+        self.start_workers()
+        self.queue.put(job.id)
+
+    def cancel(self, job):
+        self.set_running_flag(job.campaign_id, False)
+        self.transition(job, JobStatus.CANCELLED)
+
+    def get_campaign_lock(self, campaign_id):
+        with self.lock:
+            return self.campaign_locks.setdefault(campaign_id, threading.Lock())
+
+    def work(self):
+        while True:
+            job = self.jobs.get(self.queue.get())
+
+            try:
+                # the job may have been cancelled while queued and pruned since
+                if job is None:
+                    continue
+
+                with self.get_campaign_lock(job.campaign_id):
+                    with self.lock:
+                        # the job may have been paused or cancelled while queued
+                        if job.status != JobStatus.QUEUED:
+                            continue
+
+                        self.set_running_flag(job.campaign_id, True)
+                        self.transition(job, JobStatus.RUNNING)
+
+                    self.run_job(job)
+            except Exception:
+                logger.exception(f"Job {job.id} ({job.campaign_id}) failed")
+            finally:
+                self.queue.task_done()
+
+    def run_job(self, job):
+        try:
+            campaign = utils.load_campaign(self.app, campaign_id=job.campaign_id, mode=job.mode)
+            model = ModelFactory.from_config(campaign.metadata["config"], mode=job.mode)
+
+            result = utils.run_llm_campaign(
+                job.mode,
+                job.campaign_id,
+                self.app.db["announcers"].get(job.campaign_id),
+                campaign,
+                self.app.db["datasets_obj"],
+                model,
+                self.app.db["threads"],
+            )
+        except Exception as e:
+            traceback.print_exc()
+            result = {"success": False, "error": f"Error while running campaign: {e}"}
+
+            campaign = utils.load_campaign(self.app, campaign_id=job.campaign_id, mode=job.mode)
+            if campaign.metadata["status"] == CampaignStatus.RUNNING:
+                campaign.metadata["status"] = CampaignStatus.IDLE
+                campaign.update_metadata()
+
+        with self.lock:
+            if job.status == JobStatus.PAUSING:
+                job.campaign_status = result.get("status")
+                self.transition(job, JobStatus.PAUSED, message=result.get("final_message") or result.get("error"))
+                return
+
+            # a resumed or cancelled job keeps its state
+            if job.status != JobStatus.RUNNING:
+                return
+
+            if result["success"]:
+                job.campaign_status = result["status"]
+                self.transition(job, JobStatus.FINISHED, message=result["final_message"])
+            else:
+                self.transition(job, JobStatus.FAILED, message=result["error"])
@@ -14,6 +14,7 @@ import json
 import json2table
 import pandas as pd
 
+from factgenie.loaders.jsonl_file import JSONLFile
 from factgenie.utils import resumable_download
 
 
@@ -85,6 +86,10 @@ class PlainTextDataset(BasicDataset):
 
         return examples
 
+    def count_examples(self, split, data_path):
+        with open(f"{data_path}/{split}.txt", "rb") as f:
+            return sum(1 for _ in f)
+
     def render(self, example):
         html = "<div>"
         html += "<p>"
@@ -118,14 +123,20 @@ class JSONDataset(BasicDataset):
 
 class JSONLDataset(BasicDataset):
     def load_examples(self, split, data_path):
-        examples = []
+        examples = JSONLFile(f"{data_path}/{split}.jsonl")
 
-        with open(f"{data_path}/{split}.jsonl") as f:
-            for line in f:
-                examples.append(json.loads(line))
+        if self.has_postprocessing():
+            # the postprocessing works with the list of parsed examples
+            with examples:
+                return list(examples)
 
+        # the examples are parsed on access
         return examples
 
+    def count_examples(self, split, data_path):
+        with JSONLFile(f"{data_path}/{split}.jsonl") as examples:
+            return len(examples)
+
     def render(self, example):
         # default method, can be overwritten by dataset classes
         html = json2table.convert(
@@ -190,5 +201,10 @@ class HTMLDataset(BasicDataset):
 
         return examples
 
+    def count_examples(self, split, data_path):
+        split_dir = Path(f"{data_path}/{split}")
+
+        return sum(1 for filename in split_dir.iterdir() if filename.suffix == ".html")
+
     def render(self, example):
         return example
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 import logging
 import requests
-import json
 import os
 import zipfile
 import importlib
 import inspect
+import itertools
+import hashlib
+import pickle
+import threading
 
 
 from pathlib import Path
@@ -13,10 +16,15 @@ from collections import defaultdict
 from slugify import slugify
 from abc import ABC, abstractmethod
 
-from factgenie import DATA_DIR, OUTPUT_DIR
+from factgenie import CACHE_DIR, DATA_DIR, OUTPUT_DIR
+from factgenie.loaders.jsonl_file import JSONLFile, JSONLRecordMap
 
 logger = logging.getLogger(__name__)
 
+SNAPSHOT_DIR = CACHE_DIR / "snapshots"
+
+render_versions = itertools.count()
+
 
 def get_dataset_classes():
     module_name = "factgenie.loaders"
@@ -36,6 +44,54 @@ def get_dataset_classes():
     return classes
 
 
+def add_outputs_from_file(outputs, path):
+    # only the offsets and keys of the outputs are kept in memory, the outputs are parsed on access
+    records = JSONLFile(path, key_fn=lambda j: (j["split"], slugify(j["setup_id"]), j["example_idx"]))
+
+    for position, (split, setup_id, example_idx) in enumerate(records.keys):
+        if split not in outputs:
+            outputs[split] = {}
+
+        if setup_id not in outputs[split]:
+            outputs[split][setup_id] = JSONLRecordMap()
+
+        outputs[split][setup_id].add(example_idx, records, position)
+
+
+def copy_outputs(outputs):
+    # the outputs are replaced by an updated copy instead of being modified in place, so that the readers never
+    # see them half-updated
+    outputs_copy = defaultdict(dict)
+
+    for split, split_outputs in outputs.items():
+        outputs_copy[split] = {setup_id: records.copy() for setup_id, records in split_outputs.items()}
+
+    return outputs_copy
+
+
+def remove_outputs_from_file(outputs, path):
+    path = Path(path).resolve()
+    # the removed files are returned, so that they can be closed once the outputs are not used anymore
+    removed_files = set()
+
+    for split_outputs in outputs.values():
+        for setup_id, records in list(split_outputs.items()):
+            removed_files.update(jsonl_file for jsonl_file in records.get_files() if jsonl_file.path == path)
+            records.remove_file(path)
+
+            if not records:
+                split_outputs.pop(setup_id)
+
+    return removed_files
+
+
+def close_outputs(outputs):
+    for split_outputs in outputs.values():
+        for records in split_outputs.values():
+            for jsonl_file in records.get_files():
+                jsonl_file.close()
+
+
 class Dataset(ABC):
     """
     Abstract class for datasets.
@@ -46,20 +102,29 @@ class Dataset(ABC):
         self.data_path = DATA_DIR / self.id
         self.output_path = OUTPUT_DIR / self.id
 
+        # distinguishes the instances of the dataset in the cache of rendered examples
+        self.render_version = next(render_versions)
+
         self.splits = kwargs.get("splits", ["train", "dev", "test"])
         self.description = kwargs.get("description", "")
 
-        # load data
+        # the splits are loaded on first access (see `get_examples`)
         self.examples = {}
-
-        for split in self.splits:
-            examples = self.load_examples(split=split, data_path=self.data_path)
-            examples = self.postprocess_data(examples=examples)
-
-            self.examples[split] = examples
-
-        # load outputs
-        self.outputs = self.load_generated_outputs(self.output_path)
+        self.example_counts = {}
+        self.examples_lock = threading.Lock()
+        # post-processed splits are cached in binary snapshots
+        self.use_snapshots = kwargs.get("snapshots", True)
+
+        # load outputs, the outputs are reloaded only if the files in `output_path` change (see `refresh_outputs`)
+        self.outputs_lock = threading.Lock()
+
+        if kwargs.get("load_outputs", True):
+            self.outputs_fingerprint = self.get_outputs_fingerprint()
+            self.outputs = self.load_generated_outputs(self.output_path)
+        else:
+            # e.g. when the instance is used only for building the snapshots of the examples
+            self.outputs_fingerprint = set()
+            self.outputs = defaultdict(dict)
 
     # --------------------------------
     # TODO: implement in subclasses
@@ -102,6 +167,27 @@ class Dataset(ABC):
         """
         pass
 
+    def count_examples(self, split, data_path):
+        """
+        Count the examples in the split without loading them.
+
+        Optional, used for the dataset overview so that the splits do not need to be loaded. Needs to return the
+        same number as `len(load_examples(...))`.
+
+        Parameters
+        ----------
+        split : str
+            Split to count the examples for.
+        data_path : str
+            Path to the data directory.
+
+        Returns
+        -------
+        count : int
+            Number of examples in the split, or None if the examples cannot be counted without loading them.
+        """
+        return None
+
     @classmethod
     def download(
         cls,
@@ -159,28 +245,80 @@ class Dataset(ABC):
         outputs = defaultdict(dict)
 
         # find recursively all JSONL files in the output directory
-        outs = list(Path(output_path).glob("**/*.jsonl"))
+        outs = sorted(Path(output_path).glob("**/*.jsonl"))
 
         for out in outs:
-            with open(out) as f:
-                for line in f:
-                    j = json.loads(line)
+            add_outputs_from_file(outputs, out)
+            logger.info(f"Loaded output file: {out}")
 
-                    split = j["split"]
-                    setup_id = slugify(j["setup_id"])
-                    example_idx = j["example_idx"]
+        return outputs
 
-                    if split not in outputs:
-                        outputs[split] = {}
+    def get_outputs_fingerprint(self):
+        """
+        Get the paths, sizes and modification times of the output files.
+        """
+        fingerprint = set()
 
-                    if setup_id not in outputs[split]:
-                        outputs[split][setup_id] = {}
+        for out in Path(self.output_path).glob("**/*.jsonl"):
+            stat = out.stat()
+            fingerprint.add((str(out), stat.st_size, stat.st_mtime_ns))
 
-                    outputs[split][setup_id][example_idx] = j
+        return fingerprint
 
-                logger.info(f"Loaded output file: {out}")
+    def refresh_outputs(self):
+        """
+        Reload the generated outputs if the output files have changed since they were loaded.
+        """
+        with self.outputs_lock:
+            fingerprint = self.get_outputs_fingerprint()
 
-        return outputs
+            if fingerprint != self.outputs_fingerprint:
+                previous_outputs = self.outputs
+                self.outputs = self.load_generated_outputs(self.output_path)
+                self.outputs_fingerprint = fingerprint
+
+                close_outputs(previous_outputs)
+
+    def add_outputs_file(self, path):
+        """
+        Add the outputs from a new (or rewritten) output file without reloading the other files.
+        """
+        with self.outputs_lock:
+            outputs = copy_outputs(self.outputs)
+            removed_files = remove_outputs_from_file(outputs, path)
+            add_outputs_from_file(outputs, path)
+
+            self.outputs = outputs
+            self.outputs_fingerprint = self.get_outputs_fingerprint()
+
+            for jsonl_file in removed_files:
+                jsonl_file.close()
+
+    def remove_outputs(self, split, setup_id):
+        """
+        Remove the outputs of the setup after its files have been deleted.
+        """
+        with self.outputs_lock:
+            outputs = copy_outputs(self.outputs)
+            records = outputs[split].pop(setup_id, None)
+
+            self.outputs = outputs
+            self.outputs_fingerprint = self.get_outputs_fingerprint()
+
+            if records is not None:
+                for jsonl_file in records.get_files():
+                    jsonl_file.close()
+
+    def close(self):
+        """
+        Release the memory-mapped files of the outputs and examples, e.g. when the dataset is removed from the app.
+        """
+        with self.outputs_lock:
+            close_outputs(self.outputs)
+
+        for examples in self.examples.values():
+            if isinstance(examples, JSONLFile):
+                examples.close()
 
     def postprocess_data(self, examples):
         """
@@ -193,21 +331,26 @@ class Dataset(ABC):
         """
         return examples
 
+    def has_postprocessing(self):
+        """
+        Check whether the subclass overrides `postprocess_data`.
+        """
+        return type(self).postprocess_data is not Dataset.postprocess_data
+
     def get_outputs_for_split(self, split):
         """
         Get the list of generated outputs for the given split.
         """
-        return self.outputs[split]
+        return self.outputs.get(split, {})
 
     def get_output_for_idx_by_setup(self, split, output_idx, setup_id):
         """
         Get the generated output for the given split, output index, and setup ID.
         """
-        if setup_id in self.outputs[split]:
-            model_out = self.outputs[split][setup_id]
+        model_out = self.get_outputs_for_split(split).get(setup_id)
 
-            if output_idx in model_out:
-                return model_out[output_idx]["out"]
+        if model_out is not None and output_idx in model_out:
+            return model_out[output_idx]["out"]
 
         logger.warning(f"No output found for {setup_id=}, {output_idx=}, {split=}")
         return None
@@ -218,17 +361,110 @@ class Dataset(ABC):
         """
         outs_all = []
 
-        for outs in self.outputs[split].values():
+        for outs in self.get_outputs_for_split(split).values():
             if output_idx in outs:
                 outs_all.append(outs[output_idx])
 
         return outs_all
 
+    def get_examples(self, split):
+        """
+        Get the list of examples for the given split, loading the split on first access.
+        """
+        if split not in self.examples:
+            with self.examples_lock:
+                if split not in self.examples:
+                    if self.use_snapshots and self.has_postprocessing():
+                        examples = self.load_snapshot(split)
+                    else:
+                        examples = self.load_examples(split=split, data_path=self.data_path)
+                        examples = self.postprocess_data(examples=examples)
+
+                    self.examples[split] = examples
+
+        return self.examples[split]
+
+    def get_source_files(self, split):
+        """
+        Get the list of data files from which the split is loaded (used for invalidating the snapshots).
+        """
+        data_path = Path(self.data_path)
+        files = [f for f in data_path.glob(f"{split}.*") if f.is_file()]
+        files += [f for f in data_path.glob(f"{split}/**/*") if f.is_file()]
+
+        if not files:
+            # the loader uses a different layout, consider all the data files
+            files = [f for f in data_path.glob("**/*") if f.is_file()]
+
+        return sorted(files)
+
+    def get_snapshot_key(self, split):
+        cls = type(self)
+        h = hashlib.sha1(f"{cls.__module__}.{cls.__qualname__}".encode())
+
+        # changing the loader code invalidates the snapshot
+        for method in [self.load_examples, self.postprocess_data]:
+            try:
+                h.update(inspect.getsource(method).encode())
+            except (OSError, TypeError):
+                pass
+
+        # the files are identified by their size and modification time, hashing the content would be too slow
+        for f in self.get_source_files(split):
+            stat = f.stat()
+            h.update(f"{f}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+        return h.hexdigest()
+
+    def get_snapshot_path(self, split):
+        # the key is a part of the filename, so that the snapshot can be validated without reading it
+        return SNAPSHOT_DIR / self.id / f"{split}-{self.get_snapshot_key(split)}.pkl"
+
+    def has_snapshot(self, split):
+        return self.get_snapshot_path(split).exists()
+
+    def load_snapshot(self, split):
+        """
+        Load the post-processed examples from the snapshot in `SNAPSHOT_DIR`, (re)building the snapshot if the
+        source files or the loader have changed.
+        """
+        snapshot_path = self.get_snapshot_path(split)
+
+        if snapshot_path.exists():
+            try:
+                with open(snapshot_path, "rb") as f:
+                    examples = pickle.load(f)
+
+                logger.info(f"Loaded {self.id}/{split} from snapshot")
+                return examples
+            except Exception:
+                logger.warning(f"Invalid snapshot {snapshot_path}, rebuilding")
+
+        examples = self.load_examples(split=split, data_path=self.data_path)
+        examples = self.postprocess_data(examples=examples)
+
+        try:
+            os.makedirs(snapshot_path.parent, exist_ok=True)
+            tmp_path = snapshot_path.with_suffix(f".{os.getpid()}.tmp")
+
+            with open(tmp_path, "wb") as f:
+                pickle.dump(examples, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, snapshot_path)
+
+            # remove the outdated snapshots of the split
+            for old_path in snapshot_path.parent.glob(f"{split}-{'?' * 40}.pkl"):
+                if old_path != snapshot_path:
+                    old_path.unlink(missing_ok=True)
+        except Exception:
+            logger.exception(f"Could not save snapshot {snapshot_path}")
+
+        return examples
+
     def get_example(self, split, example_idx):
         """
         Get the example at the given index for the given split.
         """
-        example = self.examples[split][example_idx]
+        example = self.get_examples(split)[example_idx]
 
         return example
 
@@ -237,9 +473,24 @@ class Dataset(ABC):
         Get the number of examples in the dataset.
         """
         if split is None:
-            return sum([len(exs) for exs in self.examples.values()])
+            return sum([self.get_example_count(split) for split in self.splits])
+
+        if split in self.examples:
+            return len(self.examples[split])
+
+        if split not in self.example_counts:
+            count = None
+
+            # the postprocessing may change the number of examples
+            if not self.has_postprocessing():
+                count = self.count_examples(split=split, data_path=self.data_path)
+
+            if count is None:
+                count = len(self.get_examples(split))
+
+            self.example_counts[split] = count
 
-        return len(self.examples[split])
+        return self.example_counts[split]
 
     def get_splits(self):
         """
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pickle
+import threading
+
+from array import array
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+
+from factgenie import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+JSONL_INDEX_DIR = CACHE_DIR / "jsonl_index"
+
+
+class JSONLFile(Sequence):
+    """
+    Random access to the records of a JSONL file.
+
+    The byte offsets of the records are kept in an index file in `JSONL_INDEX_DIR` (rebuilt when the JSONL file
+    changes). The JSONL file is memory-mapped and a record is parsed only when it is accessed.
+
+    With `key_fn`, the index also stores a key computed from each record (e.g. the example index of a model output),
+    so that the records can be looked up without parsing the file again.
+
+    The memory map is released with `close()` (or by using the file as a context manager), it is reopened if the
+    records are accessed again.
+    """
+
+    def __init__(self, path, key_fn=None):
+        self.path = Path(path).resolve()
+        self.key_fn = key_fn
+        self.mmap = None
+        self.mmap_lock = threading.Lock()
+
+        self.offsets, self.keys = self.load_index()
+
+    def get_key_fn_id(self):
+        """
+        Identify the key function, so that the keys computed by another function are not loaded from the index.
+        """
+        if self.key_fn is None:
+            return ""
+
+        code = self.key_fn.__code__
+        code_digest = hashlib.sha1(code.co_code + repr((code.co_consts, code.co_names)).encode()).hexdigest()
+
+        return f"{self.key_fn.__module__}.{self.key_fn.__qualname__}:{code_digest}"
+
+    def get_index_path(self):
+        digest = hashlib.sha1(f"{self.path}\n{self.get_key_fn_id()}".encode()).hexdigest()
+        return JSONL_INDEX_DIR / f"{digest}.pkl"
+
+    def load_index(self):
+        stat = os.stat(self.path)
+        index_path = self.get_index_path()
+
+        if index_path.exists():
+            try:
+                with open(index_path, "rb") as f:
+                    index = pickle.load(f)
+
+                if (
+                    index["size"] == stat.st_size
+                    and index["mtime"] == stat.st_mtime_ns
+                    and (self.key_fn is None or index["keys"] is not None)
+                ):
+                    return index["offsets"], index["keys"]
+            except Exception:
+                logger.warning(f"Invalid index {index_path} for {self.path}, rebuilding")
+
+        offsets, keys = self.build_index()
+
+        os.makedirs(JSONL_INDEX_DIR, exist_ok=True)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"size": stat.st_size, "mtime": stat.st_mtime_ns, "offsets": offsets, "keys": keys}, f)
+        os.replace(tmp_path, index_path)
+
+        return offsets, keys
+
+    def build_index(self):
+        offsets = array("q")
+        keys = [] if self.key_fn is not None else None
+
+        with open(self.path, "rb") as f:
+            pos = 0
+
+            for line in f:
+                if line.strip():
+                    offsets.append(pos)
+
+                    if keys is not None:
+                        keys.append(self.key_fn(json.loads(line)))
+
+                pos += len(line)
+
+        logger.info(f"Indexed {len(offsets)} records in {self.path}")
+        return offsets, keys
+
+    def get_mmap(self):
+        # called with `mmap_lock` held
+        if self.mmap is None:
+            with open(self.path, "rb") as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mmap
+
+    def close(self):
+        with self.mmap_lock:
+            if self.mmap is not None:
+                self.mmap.close()
+                self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        start = self.offsets[idx]
+
+        # the record is copied out of the memory map under the lock, so that `close()` cannot unmap it meanwhile
+        with self.mmap_lock:
+            mm = self.get_mmap()
+            end = mm.find(b"\n", start)
+            line = mm[start : end if end != -1 else len(mm)]
+
+        return json.loads(line)
+
+
+class JSONLRecordMap(Mapping):
+    """
+    Mapping of keys to records stored in JSONL files, the records are parsed on access.
+    """
+
+    def __init__(self):
+        # key -> (JSONLFile, position of the record in the file)
+        self.positions = {}
+
+    def add(self, key, jsonl_file, position):
+        self.positions[key] = (jsonl_file, position)
+
+    def copy(self):
+        records = JSONLRecordMap()
+        records.positions = dict(self.positions)
+        return records
+
+    def get_files(self):
+        return {jsonl_file for jsonl_file, _ in self.positions.values()}
+
+    def remove_file(self, path):
+        self.positions = {key: value for key, value in self.positions.items() if value[0].path != path}
+
+    def __getitem__(self, key):
+        jsonl_file, position = self.positions[key]
+        return jsonl_file[position]
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
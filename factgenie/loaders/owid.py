@@ -22,6 +22,9 @@ class OurWorldInData(QuintdDataset, Dataset):
 
         return examples
 
+    def count_examples(self, split, data_path):
+        return sum(1 for _ in Path(f"{data_path}/{split}").iterdir())
+
     def render(self, example):
         # parse the csv comments, e.g. 'country: country_name' as Python dict
         lines_starting_with_hash = [
@@ -25,7 +25,16 @@ from collections import defaultdict
 import urllib.parse
 from slugify import slugify
 
-from factgenie.campaigns import HumanCampaign, CampaignStatus, ExampleStatus, ANNOTATIONS_DIR, GENERATIONS_DIR
+from factgenie.campaigns import (
+    HumanCampaign,
+    CampaignStatus,
+    CampaignStorage,
+    ExampleStatus,
+    ANNOTATIONS_DIR,
+    GENERATIONS_DIR,
+)
+from factgenie.response_cache import get_response_cache
+from factgenie.jobs import JobRunner
 from factgenie.models import ModelFactory
 from factgenie.loaders.dataset import get_dataset_classes
 import factgenie.utils as utils
@@ -36,19 +45,45 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 DIR_PATH = os.path.dirname(__file__)
 TEMPLATES_DIR = os.path.join(DIR_PATH, "templates")
 STATIC_DIR = os.path.join(DIR_PATH, "static")
+# maximum number of examples in a single `/examples` request
+MAX_BULK_EXAMPLES = 500
+# number of examples shown on a single page of the LLM campaign detail
+LLM_CAMPAIGN_PAGE_SIZE = 100
 
 
 app = Flask("factgenie", template_folder=TEMPLATES_DIR, static_folder=STATIC_DIR)
 app.db = {}
-app.db["annotation_index"] = {}
 app.db["lock"] = threading.Lock()
+app.db["campaign_locks"] = {}
+app.db["campaign_index_lock"] = threading.Lock()
+app.db["campaign_index_reloads"] = 0
 app.db["threads"] = {}
 app.db["announcers"] = {}
+app.db["render_cache"] = utils.RenderCache()
+app.db["job_runner"] = JobRunner(app)
+app.db["datasets_obj"] = {}
+app.db["datasets_loading"] = set()
+app.db["datasets_loader_started"] = False
 app.wsgi_app = ProxyFix(app.wsgi_app, x_host=1)
 
 logger = logging.getLogger(__name__)
 
 
+@app.before_request
+def start_loading_datasets():
+    # the datasets are loaded only when the app serves requests, not when the CLI commands create the app
+    if app.db["datasets_loader_started"]:
+        return
+
+    with app.db["lock"]:
+        if app.db["datasets_loader_started"]:
+            return
+        app.db["datasets_loader_started"] = True
+
+        # the datasets are marked as loading until they are instantiated
+        utils.load_datasets_in_background(app)
+
+
 # -----------------
 # Jinja filters
 # -----------------
@@ -182,12 +217,17 @@ def annotate():
     campaign_id = request.args.get("campaign")
     campaign = utils.load_campaign(app, campaign_id=campaign_id, mode="crowdsourcing")
 
+    # no batch is assigned until the examples can be shown to the annotator
+    loading_datasets = utils.get_loading_datasets(app, campaign)
+
+    if loading_datasets:
+        return f"The datasets {', '.join(loading_datasets)} are still loading, please retry in a moment.", 503
+
     service = campaign.metadata["config"]["service"]
     service_ids = utils.get_service_ids(service, request.args)
 
-    db = campaign.db
     metadata = campaign.metadata
-    annotation_set = utils.get_annotator_batch(app, campaign, db, service_ids)
+    annotation_set = utils.get_annotator_batch(app, campaign, service_ids)
 
     if not annotation_set:
         # no more available examples
@@ -206,6 +246,33 @@ def annotate():
     )
 
 
+@app.route("/annotations", methods=["GET"])
+@login_required
+def get_annotations():
+    dataset_id = request.args.get("dataset")
+    split = request.args.get("split")
+    example_idx = int(request.args.get("example_idx"))
+    setup_id = request.args.get("setup_id")
+    campaign_id = request.args.get("campaign")
+    categories = request.args.getlist("category")
+
+    try:
+        if setup_id is None:
+            # the annotations of all the outputs of the example, grouped by their `setup_id`
+            annotations = utils.get_annotations_by_setup(
+                app, dataset_id, split, example_idx, campaign_id=campaign_id, categories=categories
+            )
+        else:
+            annotations = utils.get_annotations(
+                app, dataset_id, split, example_idx, setup_id=setup_id, campaign_id=campaign_id, categories=categories
+            )
+        return jsonify(annotations)
+    except Exception as e:
+        traceback.print_exc()
+        logger.error(f"Error while getting annotations: {e}")
+        return jsonify({"error": f"Error while getting annotations: {e}"})
+
+
 @app.route("/browse", methods=["GET", "POST"])
 @login_required
 def browse():
@@ -224,7 +291,7 @@ def browse():
         display_example = None
 
     datasets = utils.get_local_dataset_overview(app)
-    datasets = {k: v for k, v in datasets.items() if v["enabled"]}
+    datasets = {k: v for k, v in datasets.items() if v["enabled"] and not v["loading"]}
 
     if not datasets:
         return render_template(
@@ -237,10 +304,56 @@ def browse():
         display_example=display_example,
         datasets=datasets,
         host_prefix=app.config["host_prefix"],
-        annotations=app.db["annotation_index"],
     )
 
 
+@app.route("/campaigns", methods=["GET"])
+@login_required
+def campaigns_list():
+    sources = request.args.get("sources", "crowdsourcing,llm_eval,llm_gen,external").split(",")
+    offset = int(request.args.get("offset", 0))
+    limit = request.args.get("limit")
+    limit = int(limit) if limit else None
+
+    page = utils.get_campaign_list_page(
+        app,
+        sources=sources,
+        offset=offset,
+        limit=limit,
+        sort_by=request.args.get("sort") or "created",
+        order=request.args.get("order", "desc"),
+        search=request.args.get("search"),
+    )
+    return jsonify(page)
+
+
+@app.route("/campaigns/examples", methods=["GET"])
+@login_required
+def campaign_examples():
+    campaign_id = request.args.get("campaign")
+    source = request.args.get("source")
+    offset = int(request.args.get("offset", 0))
+    limit = request.args.get("limit")
+    limit = int(limit) if limit else None
+    columns = request.args.get("columns")
+    columns = columns.split(",") if columns else None
+
+    filters = {
+        col: request.args.get(col)
+        for col in ["dataset", "split", "setup_id", "status", "annotator_id", "batch_idx"]
+        if request.args.get(col) is not None
+    }
+
+    try:
+        campaign = utils.load_campaign(app, campaign_id=campaign_id, mode=source)
+        page = utils.get_campaign_examples(campaign, offset=offset, limit=limit, filters=filters, columns=columns)
+        return jsonify(page)
+    except Exception as e:
+        traceback.print_exc()
+        logger.error(f"Error while getting campaign examples: {e}")
+        return jsonify({"error": f"Error while getting campaign examples: {e}"})
+
+
 @app.route("/crowdsourcing", methods=["GET", "POST"])
 @login_required
 def crowdsourcing():
@@ -308,7 +421,8 @@ def crowdsourcing_create():
 
     # create the annotation CSV
     db = utils.generate_campaign_db(app, campaign_data, config=config)
-    db.to_csv(os.path.join(ANNOTATIONS_DIR, campaign_id, "db.csv"), index=False)
+    storage = app.config.get("campaign_storage", CampaignStorage.CSV)
+    utils.save_campaign_db(os.path.join(ANNOTATIONS_DIR, campaign_id), db, storage=storage)
 
     # save metadata
     with open(os.path.join(ANNOTATIONS_DIR, campaign_id, "metadata.json"), "w") as f:
@@ -334,7 +448,7 @@ def crowdsourcing_create():
 @login_required
 def crowdsourcing_new():
     datasets = utils.get_local_dataset_overview(app)
-    datasets = {k: v for k, v in datasets.items() if v["enabled"]}
+    datasets = {k: v for k, v in datasets.items() if v["enabled"] and not v["loading"]}
 
     model_outs = utils.get_model_outputs_overview(app, datasets, non_empty=True)
 
@@ -393,6 +507,7 @@ def delete_campaign():
         target_dir = ANNOTATIONS_DIR
 
     shutil.rmtree(os.path.join(target_dir, campaign_name))
+    utils.generate_campaign_index(app, force_reload=False)[source].pop(campaign_name, None)
 
     if os.path.exists(os.path.join(TEMPLATES_DIR, "campaigns", campaign_name)):
         shutil.rmtree(os.path.join(TEMPLATES_DIR, "campaigns", campaign_name))
@@ -483,9 +598,11 @@ def render_example():
     dataset_id = request.args.get("dataset")
     split = request.args.get("split")
     example_idx = int(request.args.get("example_idx"))
+    # the browse page loads the annotations from `/annotations`
+    with_annotations = request.args.get("annotations", "true") == "true"
 
     try:
-        example_data = utils.get_example_data(app, dataset_id, split, example_idx)
+        example_data = utils.get_example_data(app, dataset_id, split, example_idx, with_annotations=with_annotations)
         return jsonify(example_data)
     except Exception as e:
         traceback.print_exc()
@@ -494,6 +611,43 @@ def render_example():
         return jsonify({"error": f"Error\n\t{e}\nwhile getting example data: {dataset_id=}, {split=}, {example_idx=}"})
 
 
+@app.route("/examples", methods=["POST"])
+def render_examples():
+    data = request.get_json()
+    examples = data.get("examples", [])
+    with_annotations = data.get("annotations", True)
+
+    if len(examples) > MAX_BULK_EXAMPLES:
+        return jsonify({"error": f"At most {MAX_BULK_EXAMPLES} examples can be requested at once"})
+
+    try:
+        examples_data = [
+            utils.get_example_data(
+                app, ex["dataset"], ex["split"], int(ex["example_idx"]), with_annotations=with_annotations
+            )
+            for ex in examples
+        ]
+        return jsonify({"examples": examples_data})
+    except Exception as e:
+        traceback.print_exc()
+        logger.error(f"Error while getting example data: {e}")
+        return jsonify({"error": f"Error\n\t{e}\nwhile getting example data"})
+
+
+@app.route("/cache_stats", methods=["GET"])
+@login_required
+def cache_stats():
+    # size and hit rate of the caches, e.g. for tuning `render_cache_size` and `response_cache_size_mb`
+    return jsonify(
+        {
+            "render_cache": app.db["render_cache"].get_stats(),
+            "response_cache": get_response_cache().get_stats(),
+            # number of campaigns loaded from their files since the start of the app
+            "campaign_reloads": app.db["campaign_index_reloads"],
+        }
+    )
+
+
 @app.route("/export_campaign_outputs", methods=["GET", "POST"])
 @login_required
 def export_campaign_outputs():
@@ -614,21 +768,35 @@ def llm_campaign_detail():
 
     campaign_id = request.args.get("campaign")
     campaign = utils.load_campaign(app, campaign_id=campaign_id, mode=mode)
+    job = app.db["job_runner"].get_campaign_job(campaign_id)
 
-    if campaign.metadata["status"] == CampaignStatus.RUNNING and not app.db["announcers"].get(campaign_id):
+    # the campaign was left running by a server which is not running anymore
+    if campaign.metadata["status"] == CampaignStatus.RUNNING and job is None:
         campaign.metadata["status"] = CampaignStatus.IDLE
         campaign.update_metadata()
 
-    overview = campaign.get_overview()
-    finished_examples = [x for x in overview if x["status"] == ExampleStatus.FINISHED]
+    # only a single page of the examples is rendered
+    page = max(int(request.args.get("page", 1)), 1)
+    offset = (page - 1) * LLM_CAMPAIGN_PAGE_SIZE
+    overview = campaign.get_overview(offset=offset, limit=LLM_CAMPAIGN_PAGE_SIZE)
+
+    example_cnt = len(campaign.db)
+    finished_example_cnt = int((campaign.db["status"] == ExampleStatus.FINISHED).sum())
+    page_cnt = max((example_cnt + LLM_CAMPAIGN_PAGE_SIZE - 1) // LLM_CAMPAIGN_PAGE_SIZE, 1)
 
     return render_template(
         f"llm_campaign_detail.html",
         mode=mode,
         campaign_id=campaign_id,
         overview=overview,
-        finished_examples=finished_examples,
+        offset=offset,
+        page=page,
+        page_cnt=page_cnt,
+        example_cnt=example_cnt,
+        finished_example_cnt=finished_example_cnt,
         metadata=campaign.metadata,
+        job=job.to_dict() if job is not None else None,
+        response_cache=get_response_cache().get_stats() if "response_cache" in campaign.metadata else None,
         host_prefix=app.config["host_prefix"],
     )
 
@@ -642,7 +810,7 @@ def llm_campaign_new():
         return "The `mode` argument was not specified", 404
 
     datasets = utils.get_local_dataset_overview(app)
-    datasets = {k: v for k, v in datasets.items() if v["enabled"]}
+    datasets = {k: v for k, v in datasets.items() if v["enabled"] and not v["loading"]}
 
     non_empty = True if mode == "llm_eval" else False
     model_outs = utils.get_model_outputs_overview(app, datasets, non_empty=non_empty)
@@ -677,25 +845,25 @@ def llm_campaign_run():
     data = request.get_json()
     campaign_id = data.get("campaignId")
 
-    app.db["announcers"][campaign_id] = announcer = utils.MessageAnnouncer()
-
-    app.db["threads"][campaign_id] = {
-        "running": True,
-    }
-
     try:
         campaign = utils.load_campaign(app, campaign_id=campaign_id, mode=mode)
-        threads = app.db["threads"]
-        datasets = app.db["datasets_obj"]
 
-        config = campaign.metadata["config"]
-        model = ModelFactory.from_config(config, mode=mode)
-
-        return utils.run_llm_campaign(mode, campaign_id, announcer, campaign, datasets, model, threads)
+        # fail early on an invalid config, the campaign itself is run in the background
+        ModelFactory.from_config(campaign.metadata["config"], mode=mode)
     except Exception as e:
         traceback.print_exc()
         return utils.error(f"Error while running campaign: {e}")
 
+    loading_datasets = utils.get_loading_datasets(app, campaign)
+
+    if loading_datasets:
+        return utils.error(f"The datasets {', '.join(loading_datasets)} are still loading, please retry in a moment.")
+
+    job = app.db["job_runner"].submit(mode, campaign_id)
+
+    # the progress of the job is sent over SSE (/llm_campaign/progress/<campaign_id>)
+    return jsonify(success=True, job=job.to_dict())
+
 
 @app.route("/llm_campaign/progress/<campaign_id>", methods=["GET"])
 @login_required
@@ -705,6 +873,12 @@ def listen(campaign_id):
 
     def stream():
         messages = app.db["announcers"][campaign_id].listen()
+
+        # the job may have changed its state (or even finished) before the client connected
+        job = app.db["job_runner"].get_last_campaign_job(campaign_id)
+        if job is not None:
+            yield utils.format_sse(data=json.dumps(job.to_dict()), event="job")
+
         while True:
             msg = messages.get()
             yield msg
@@ -720,16 +894,65 @@ def llm_campaign_pause():
     if not mode:
         return "The `mode` argument was not specified", 404
 
+    return update_llm_campaign_job(mode, action="pause")
+
+
+@app.route("/llm_campaign/resume", methods=["POST"])
+@login_required
+def llm_campaign_resume():
+    mode = request.args.get("mode")
+
+    if not mode:
+        return "The `mode` argument was not specified", 404
+
+    return update_llm_campaign_job(mode, action="resume")
+
+
+@app.route("/llm_campaign/cancel", methods=["POST"])
+@login_required
+def llm_campaign_cancel():
+    mode = request.args.get("mode")
+
+    if not mode:
+        return "The `mode` argument was not specified", 404
+
+    return update_llm_campaign_job(mode, action="cancel")
+
+
+def update_llm_campaign_job(mode, action):
     data = request.get_json()
     campaign_id = data.get("campaignId")
-    app.db["threads"][campaign_id]["running"] = False
+    job_runner = app.db["job_runner"]
 
-    campaign = utils.load_campaign(app, campaign_id=campaign_id, mode=mode)
-    campaign.metadata["status"] = CampaignStatus.IDLE
-    campaign.update_metadata()
+    # the job can be identified by its id or by its campaign
+    job = job_runner.get_job(data.get("jobId")) or job_runner.get_campaign_job(campaign_id)
+
+    if job is None:
+        return utils.error(f"No active job for campaign {campaign_id}")
+
+    # the campaign stays running until the examples in flight are collected, `run_llm_campaign()` then marks it idle
+    try:
+        getattr(job_runner, action)(job)
+    except ValueError as e:
+        return utils.error(str(e))
 
-    resp = jsonify(success=True, status=campaign.metadata["status"])
-    return resp
+    return jsonify(success=True, job=job.to_dict())
+
+
+@app.route("/llm_campaign/jobs", methods=["GET"])
+@login_required
+def llm_campaign_jobs():
+    job_id = request.args.get("job")
+
+    if job_id:
+        job = app.db["job_runner"].get_job(job_id)
+
+        if job is None:
+            return "Job not found", 404
+
+        return jsonify(job.to_dict())
+
+    return jsonify(app.db["job_runner"].get_jobs())
 
 
 @app.route("/llm_eval/detail", methods=["GET", "POST"])
@@ -756,7 +979,7 @@ def manage():
     datasets = utils.get_local_dataset_overview(app)
     dataset_classes = list(get_dataset_classes().keys())
 
-    datasets_enabled = {k: v for k, v in datasets.items() if v["enabled"]}
+    datasets_enabled = {k: v for k, v in datasets.items() if v["enabled"] and not v["loading"]}
     model_outputs = utils.get_model_outputs_overview(app, datasets_enabled)
 
     datasets_for_download = utils.get_datasets_for_download(app)
@@ -765,8 +988,7 @@ def manage():
     for dataset_id in datasets_for_download.keys():
         datasets_for_download[dataset_id]["downloaded"] = dataset_id in datasets
 
-    campaigns = utils.get_sorted_campaign_list(app, sources=["crowdsourcing", "llm_eval", "llm_gen", "external"])
-
+    # the campaigns are loaded by the table from the `/campaigns` endpoint
     return render_template(
         "manage.html",
         datasets=datasets,
@@ -774,7 +996,6 @@ def manage():
         datasets_for_download=datasets_for_download,
         host_prefix=app.config["host_prefix"],
         model_outputs=model_outputs,
-        campaigns=campaigns,
     )
 
 
@@ -823,20 +1044,28 @@ def submit_annotations():
     save_dir = os.path.join(ANNOTATIONS_DIR, campaign_id, "files")
     os.makedirs(save_dir, exist_ok=True)
     campaign = utils.load_campaign(app, campaign_id=campaign_id, mode="crowdsourcing")
+    batch_idx = annotation_set[0]["batch_idx"]
 
-    with app.db["lock"]:
-        db = campaign.db
-        batch_idx = annotation_set[0]["batch_idx"]
+    # each submission is written into a separate file
+    save_path = os.path.join(save_dir, f"{batch_idx}-{annotator_id}-{now}.jsonl")
+    with open(save_path, "w") as f:
+        for row in annotation_set:
+            f.write(json.dumps(row) + "\n")
+
+    utils.index_annotation_file(save_path)
 
-        with open(os.path.join(save_dir, f"{batch_idx}-{annotator_id}-{now}.jsonl"), "w") as f:
-            for row in annotation_set:
-                f.write(json.dumps(row) + "\n")
+    if campaign.storage == CampaignStorage.SQLITE:
+        # the db update is a single transaction
+        campaign.finish_batch(batch_idx, now)
+    else:
+        # only the in-memory state is updated under the lock
+        with utils.get_campaign_lock(app, campaign_id):
+            db = campaign.db
+            changed_rows = campaign.finish_batch(batch_idx, now)
 
-        db.loc[db["batch_idx"] == batch_idx, "status"] = ExampleStatus.FINISHED
-        db.loc[db["batch_idx"] == batch_idx, "end"] = now
+        campaign.update_db_rows(db, changed_rows)
 
-        campaign.update_db(db)
-        logger.info(f"Annotations for {campaign_id} (batch {batch_idx}) saved")
+    logger.info(f"Annotations for {campaign_id} (batch {batch_idx}) saved")
 
     return jsonify({"status": "success"})
 
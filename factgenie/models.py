@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import traceback
+import openai
 from openai import OpenAI
 from textwrap import dedent
 import argparse
@@ -13,11 +14,16 @@ import os
 import coloredlogs
 import logging
 import time
+import random
 import requests
+from requests.adapters import HTTPAdapter
+import threading
 import copy
 
 from ast import literal_eval
 
+from factgenie.response_cache import ResponseCache, get_response_cache
+
 # logging.basicConfig(format="%(message)s", level=logging.INFO, datefmt="%H:%M:%S")
 # coloredlogs.install(level="INFO", fmt="%(asctime)s %(levelname)s %(message)s")
 logger = logging.getLogger(__name__)
@@ -55,6 +61,174 @@ class ModelFactory:
         return classes[metric_type](config)
 
 
+# HTTP status codes of the errors which are likely to disappear when the request is repeated
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RetryPolicy:
+    """
+    Number of attempts for a request and the exponential backoff between them.
+
+    The delay before the n-th retry is drawn uniformly from [0, min(max_delay, base_delay * 2^n)] ("full jitter"),
+    so that the requests of the parallel workers do not hit the API at the same time.
+    """
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=60.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+
+def is_retryable_error(e):
+    """
+    Return True if the request that raised the exception `e` may succeed when repeated.
+    """
+    if isinstance(e, (ConnectionError, TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code in RETRYABLE_STATUS_CODES
+
+    if isinstance(e, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in RETRYABLE_STATUS_CODES
+
+    return False
+
+
+def get_error_output(e):
+    return {"error": str(e), "retryable": is_retryable_error(e)}
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second up to `capacity` tokens.
+
+    The amount taken at once may exceed the capacity (e.g. a single long prompt): it is taken when the bucket is full
+    and the bucket goes into debt, delaying the following requests.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_wait_time(self, amount):
+        # the time until `amount` tokens (or a full bucket) are available
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limits of a single model endpoint.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.lock = threading.Lock()
+        self.request_bucket = None
+        self.token_bucket = None
+        self.set_limits(requests_per_minute, tokens_per_minute)
+
+    def set_limits(self, requests_per_minute=None, tokens_per_minute=None):
+        with self.lock:
+            self.request_bucket = self.update_bucket(self.request_bucket, requests_per_minute)
+            self.token_bucket = self.update_bucket(self.token_bucket, tokens_per_minute)
+            self.limits = (requests_per_minute, tokens_per_minute)
+
+    @staticmethod
+    def update_bucket(bucket, per_minute):
+        if not per_minute:
+            return None
+
+        if bucket is None:
+            return TokenBucket(per_minute / 60, per_minute)
+
+        # keep the tokens already used so that changing the limits does not reset the budget
+        bucket.refill()
+        bucket.rate = per_minute / 60
+        bucket.capacity = per_minute
+        bucket.tokens = min(bucket.tokens, per_minute)
+
+        return bucket
+
+    def acquire(self, tokens=0):
+        """
+        Block until a request using `tokens` tokens can be sent without exceeding the limits.
+        """
+        while True:
+            with self.lock:
+                buckets = [(self.request_bucket, 1), (self.token_bucket, tokens)]
+                buckets = [(bucket, amount) for bucket, amount in buckets if bucket is not None]
+
+                for bucket, _ in buckets:
+                    bucket.refill()
+
+                wait_time = max([bucket.get_wait_time(amount) for bucket, amount in buckets], default=0.0)
+
+                if wait_time == 0.0:
+                    for bucket, amount in buckets:
+                        bucket.tokens -= amount
+                    return
+
+            time.sleep(wait_time)
+
+    def record_usage(self, estimated_tokens, used_tokens):
+        # correct the estimate once the API reports the number of tokens actually used
+        with self.lock:
+            if self.token_bucket is not None:
+                self.token_bucket.tokens -= used_tokens - estimated_tokens
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(api_url, model, requests_per_minute=None, tokens_per_minute=None):
+    """
+    Return the rate limiter of the (api_url, model) endpoint, shared by all the campaigns running in the process.
+
+    If the campaigns set different limits for the same endpoint, the most restrictive ones apply, so that the limits
+    do not depend on the order in which the campaigns send their requests.
+    """
+    key = (api_url or "", model)
+
+    with rate_limiters_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute)
+            return rate_limiters[key]
+
+        rate_limiter = rate_limiters[key]
+        limits = tuple(
+            min_limit(current, requested)
+            for current, requested in zip(rate_limiter.limits, (requests_per_minute, tokens_per_minute))
+        )
+        if limits != rate_limiter.limits:
+            rate_limiter.set_limits(*limits)
+
+        return rate_limiter
+
+
+def min_limit(a, b):
+    # a missing limit means no limit
+    if not a:
+        return b
+    if not b:
+        return a
+    return min(a, b)
+
+
 class Model:
     def __init__(self, config):
         self.validate_config(config)
@@ -65,6 +239,137 @@ class Model:
             # the key in the model output that contains the annotations
             self.annotation_key = config["extra_args"].get("annotation_key", "annotations")
 
+        self.session = None
+        self.session_lock = threading.Lock()
+
+        # hits and misses of the response cache since the model was created
+        self.cache_stats = {"hits": 0, "misses": 0}
+        self.cache_stats_lock = threading.Lock()
+
+    def get_extra_arg(self, name, default=None, arg_type=None):
+        # the values of `extra_args` set in the web interface are strings
+        value = (self.config.get("extra_args") or {}).get(name)
+
+        if value is None or value == "":
+            return default
+
+        return arg_type(value) if arg_type is not None else value
+
+    def get_session(self):
+        """
+        Return the HTTP session of the model.
+
+        The session keeps the connections to the API alive between the requests. The size of the connection pool
+        (`pool_size` in `extra_args`) defaults to the number of requests sent in parallel (`max_concurrency`).
+        """
+        if self.session is None:
+            with self.session_lock:
+                if self.session is None:
+                    pool_size = self.get_extra_arg("pool_size", arg_type=int) or self.get_extra_arg(
+                        "max_concurrency", default=1, arg_type=int
+                    )
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+
+                    session = requests.Session()
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self.session = session
+
+        return self.session
+
+    def get_timeout(self):
+        # (connect, read) timeouts in seconds, `None` means waiting indefinitely
+        return (
+            self.get_extra_arg("connect_timeout", default=10.0, arg_type=float),
+            self.get_extra_arg("read_timeout", default=None, arg_type=float),
+        )
+
+    def post(self, url, **kwargs):
+        return self.get_session().post(url, timeout=self.get_timeout(), **kwargs)
+
+    def get_retry_policy(self):
+        # `max_attempts`, `retry_base_delay` and `retry_max_delay` (in seconds) in `extra_args`
+        return RetryPolicy(
+            max_attempts=self.get_extra_arg("max_attempts", default=3, arg_type=int),
+            base_delay=self.get_extra_arg("retry_base_delay", default=1.0, arg_type=float),
+            max_delay=self.get_extra_arg("retry_max_delay", default=60.0, arg_type=float),
+        )
+
+    def get_rate_limiter(self):
+        # `requests_per_minute` and `tokens_per_minute` in `extra_args`, no limit if not set
+        requests_per_minute = self.get_extra_arg("requests_per_minute", arg_type=float)
+        tokens_per_minute = self.get_extra_arg("tokens_per_minute", arg_type=float)
+
+        if not requests_per_minute and not tokens_per_minute:
+            return None
+
+        return get_rate_limiter(
+            self.config.get("api_url"), self.config["model"], requests_per_minute, tokens_per_minute
+        )
+
+    def estimate_tokens(self, prompt):
+        # a rough estimate of ~4 characters per token, plus the maximum number of generated tokens
+        model_args = self.config.get("model_args") or {}
+        max_new_tokens = model_args.get("max_tokens") or model_args.get("num_predict") or 0
+        prompt_len = len(self.config.get("system_msg") or "") + len(prompt)
+
+        return prompt_len // 4 + max(0, int(max_new_tokens))
+
+    def wait_for_rate_limit(self, prompt):
+        """
+        Wait until the request fits within the rate limits of the endpoint, return the estimated number of tokens.
+        """
+        rate_limiter = self.get_rate_limiter()
+        tokens = self.estimate_tokens(prompt)
+
+        if rate_limiter is not None:
+            rate_limiter.acquire(tokens)
+
+        return tokens
+
+    def record_token_usage(self, estimated_tokens, used_tokens):
+        rate_limiter = self.get_rate_limiter()
+
+        if rate_limiter is not None and used_tokens is not None:
+            rate_limiter.record_usage(estimated_tokens, used_tokens)
+
+    def use_response_cache(self):
+        return str(self.get_extra_arg("response_cache", default=False)).lower() in ("true", "1", "yes")
+
+    def get_cache_key(self, prompt):
+        return ResponseCache.get_key(
+            type=self.config["type"],
+            model=self.config["model"],
+            api_url=self.config.get("api_url"),
+            system_msg=self.config.get("system_msg"),
+            start_with=self.config.get("start_with"),
+            prompt=prompt,
+            model_args=self.config.get("model_args"),
+        )
+
+    def get_cached_response(self, prompt):
+        """
+        Return the response to the prompt from the response cache (enabled with `response_cache` in `extra_args`),
+        or `None` if the model needs to be called.
+        """
+        if not self.use_response_cache():
+            return None
+
+        response = get_response_cache().get(self.get_cache_key(prompt))
+
+        with self.cache_stats_lock:
+            self.cache_stats["hits" if response is not None else "misses"] += 1
+
+        return response
+
+    def cache_response(self, prompt, response):
+        if self.use_response_cache():
+            get_response_cache().put(self.get_cache_key(prompt), response)
+
+    def get_cache_stats(self):
+        with self.cache_stats_lock:
+            return dict(self.cache_stats)
+
     def get_annotator_id(self):
         return "llm-" + self.config["type"] + "-" + self.config["model"]
 
@@ -128,8 +433,8 @@ class LLMMetric(Model):
         current_pos = 0
 
         if self.annotation_key not in model_json:
-            logger.error(f"Cannot find the key `{self.annotation_key}` in {model_json=}")
-            return []
+            # not an empty list, the example would look like it has no errors
+            raise ValueError(f"Cannot find the key `{self.annotation_key}` in {model_json=}")
 
         for annotation in model_json[self.annotation_key]:
             # find the `start` index of the error in the text
@@ -195,26 +500,38 @@ class OpenAIMetric(LLMMetric):
     def annotate_example(self, data, text):
         try:
             prompt = self.prompt(data, text)
+            annotation_str = self.get_cached_response(prompt)
+            is_cached = annotation_str is not None
+
+            if annotation_str is None:
+                estimated_tokens = self.wait_for_rate_limit(prompt)
+
+                logger.debug(f"Calling OpenAI API with prompt: {prompt}")
+                response = self.client.chat.completions.create(
+                    model=self.config["model"],
+                    response_format={"type": "json_object"},
+                    messages=[
+                        {"role": "system", "content": self.config["system_msg"]},
+                        {"role": "user", "content": prompt},
+                    ],
+                    **self.config.get("model_args", {}),
+                )
+                self.record_token_usage(estimated_tokens, response.usage.total_tokens if response.usage else None)
+                annotation_str = response.choices[0].message.content
 
-            logger.debug(f"Calling OpenAI API with prompt: {prompt}")
-            response = self.client.chat.completions.create(
-                model=self.config["model"],
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": self.config["system_msg"]},
-                    {"role": "user", "content": prompt},
-                ],
-                **self.config.get("model_args", {}),
-            )
-            annotation_str = response.choices[0].message.content
             j = json.loads(annotation_str)
             logger.info(j)
+            annotations = self.postprocess_annotations(text=text, model_json=j)
+
+            # only the responses which were processed successfully are cached
+            if not is_cached:
+                self.cache_response(prompt, annotation_str)
 
-            return self.postprocess_annotations(text=text, model_json=j)
+            return annotations
         except Exception as e:
             traceback.print_exc()
             logger.error(e)
-            return {"error": str(e)}
+            return get_error_output(e)
 
 
 class OllamaMetric(LLMMetric):
@@ -253,27 +570,44 @@ class OllamaMetric(LLMMetric):
         msg = f"Ollama API {self.config['api_url']} with args:\n\t{request_d}"
         response, annotation_str, j = None, None, None
         try:
-            logger.debug(f"Calling {msg}")
-            response = requests.post(self.config["api_url"], json=request_d)
-            response_json = response.json()
+            annotation_str = self.get_cached_response(prompt)
+            is_cached = annotation_str is not None
 
-            if "error" in response_json:
-                return response_json
+            if annotation_str is None:
+                estimated_tokens = self.wait_for_rate_limit(prompt)
 
-            annotation_str = response_json["response"]
+                logger.debug(f"Calling {msg}")
+                response = self.post(self.config["api_url"], json=request_d)
+                response_json = response.json()
+
+                if "error" in response_json:
+                    retryable = response.status_code in RETRYABLE_STATUS_CODES
+                    return {"error": response_json["error"], "retryable": retryable}
+
+                self.record_token_usage(
+                    estimated_tokens, response_json.get("prompt_eval_count", 0) + response_json.get("eval_count", 0)
+                )
+
+                annotation_str = response_json["response"]
 
             j = self.postprocess_output(annotation_str)
             logger.info(j)
-            return self.postprocess_annotations(text=text, model_json=j)
+            annotations = self.postprocess_annotations(text=text, model_json=j)
+
+            # only the responses which were processed successfully are cached
+            if not is_cached:
+                self.cache_response(prompt, annotation_str)
+
+            return annotations
         except (ConnectionError, requests.exceptions.ConnectionError) as e:
             # notifiy the user that the API is down
             logger.error(f"Connection error: {e}")
-            return {"error": str(e)}
+            return get_error_output(e)
         except Exception as e:
-            # ignore occasional problems not to interrupt the annotation process
+            # the example is marked as failed, the invalid output is not stored
             logger.error(f"Received\n\t{response=}\n\t{annotation_str=}\n\t{j=}\nError:{e}")
             traceback.print_exc()
-            return []
+            return get_error_output(e)
 
 
 class LLMGen(Model):
@@ -302,6 +636,9 @@ class LLMGen(Model):
 
         return output
 
+    def is_valid_output(self, output):
+        return isinstance(output, str) and len(output.strip()) > 0
+
     def prompt(self, data):
         prompt_template = self.config["prompt_template"]
         data = self.preprocess_data_for_prompt(data)
@@ -354,21 +691,34 @@ class OpenAIGen(LLMGen):
             if self.config.get("start_with"):
                 messages.append({"role": "assistant", "content": self.config["start_with"]})
 
-            logger.debug(f"Calling OpenAI API with prompt: {prompt}")
-            response = self.client.chat.completions.create(
-                model=self.config["model"],
-                messages=messages,
-                **self.config.get("model_args", {}),
-            )
-            output = response.choices[0].message.content
+            output = self.get_cached_response(prompt)
+            is_cached = output is not None
+
+            if output is None:
+                estimated_tokens = self.wait_for_rate_limit(prompt)
+
+                logger.debug(f"Calling OpenAI API with prompt: {prompt}")
+                response = self.client.chat.completions.create(
+                    model=self.config["model"],
+                    messages=messages,
+                    **self.config.get("model_args", {}),
+                )
+                self.record_token_usage(estimated_tokens, response.usage.total_tokens if response.usage else None)
+                output = response.choices[0].message.content
+
             logger.info(output)
+            result = {"prompt": prompt, "output": self.postprocess_output(output)}
 
-            return {"prompt": prompt, "output": self.postprocess_output(output)}
+            # only valid outputs are cached
+            if not is_cached and self.is_valid_output(output):
+                self.cache_response(prompt, output)
+
+            return result
 
         except Exception as e:
             traceback.print_exc()
             logger.error(e)
-            return {"error": str(e)}
+            return get_error_output(e)
 
 
 class TextGenerationWebuiGen(LLMGen):
@@ -399,24 +749,37 @@ class TextGenerationWebuiGen(LLMGen):
                 messages.append({"role": "assistant", "content": self.config["start_with"]})
 
             model_args = self.config.get("model_args", {})
-            logger.debug(f"Calling Text Generation Webui API with prompt: {prompt}")
-            response = requests.post(
-                api_url,
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {api_key}",
-                },
-                json={"model": self.config["model"], "messages": messages, **model_args},
-            )
-
-            output = response.choices[0].message.content
+            output = self.get_cached_response(prompt)
+            is_cached = output is not None
+
+            if output is None:
+                self.wait_for_rate_limit(prompt)
+
+                logger.debug(f"Calling Text Generation Webui API with prompt: {prompt}")
+                response = self.post(
+                    api_url,
+                    headers={
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {api_key}",
+                    },
+                    json={"model": self.config["model"], "messages": messages, **model_args},
+                )
+
+                response.raise_for_status()
+                output = response.json()["choices"][0]["message"]["content"]
+
             logger.info(output)
+            result = {"prompt": prompt, "output": self.postprocess_output(output)}
+
+            # only valid outputs are cached
+            if not is_cached and self.is_valid_output(output):
+                self.cache_response(prompt, output)
 
-            return {"prompt": prompt, "output": self.postprocess_output(output)}
+            return result
         except Exception as e:
             traceback.print_exc()
             logger.error(e)
-            return {"error": str(e)}
+            return get_error_output(e)
 
 
 class OllamaGen(LLMGen):
@@ -451,23 +814,41 @@ class OllamaGen(LLMGen):
             msg = f"Ollama API {self.config['api_url']} with args:\n\t{request_d}"
             response, output = None, None
 
-            logger.debug(f"Calling {msg}")
+            output = self.get_cached_response(prompt)
+            is_cached = output is not None
+
+            if output is None:
+                estimated_tokens = self.wait_for_rate_limit(prompt)
+
+                logger.debug(f"Calling {msg}")
 
-            response = requests.post(self.config["api_url"], json=request_d)
-            response_json = response.json()
+                response = self.post(self.config["api_url"], json=request_d)
+                response_json = response.json()
 
-            if "error" in response_json:
-                return response_json
+                if "error" in response_json:
+                    retryable = response.status_code in RETRYABLE_STATUS_CODES
+                    return {"error": response_json["error"], "retryable": retryable}
+
+                self.record_token_usage(
+                    estimated_tokens, response_json.get("prompt_eval_count", 0) + response_json.get("eval_count", 0)
+                )
+
+                output = response_json["message"]["content"]
 
-            output = response_json["message"]["content"]
             logger.info(output)
-            return {"prompt": prompt, "output": self.postprocess_output(output)}
+            result = {"prompt": prompt, "output": self.postprocess_output(output)}
+
+            # only valid outputs are cached
+            if not is_cached and self.is_valid_output(output):
+                self.cache_response(prompt, output)
+
+            return result
         except (ConnectionError, requests.exceptions.ConnectionError) as e:
             # notifiy the user that the API is down
             logger.error(f"Connection error: {e}")
-            return {"error": str(e)}
+            return get_error_output(e)
         except Exception as e:
-            # ignore occasional problems not to interrupt the annotation process
+            # the example is marked as failed, the invalid output is not stored
             logger.error(f"Received\n\t{response=}\n\t{output=}\nError:{e}")
             traceback.print_exc()
-            return []
+            return get_error_output(e)
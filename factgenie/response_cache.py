@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+
+from factgenie import RESPONSE_CACHE_PATH
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    On-disk cache of the responses of the LLM APIs, shared by all the campaigns.
+
+    The responses are addressed by a hash of everything that determines the request (see `get_key()`), so that the same
+    prompt sent within another campaign (or a re-run of the same campaign) does not call the model again. When the total
+    size of the responses exceeds `max_size` bytes, the least recently used responses are evicted.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_size=512 * 1024 * 1024):
+        self.path = str(path)
+        self.max_size = max_size
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with self.transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, accessed REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON responses (accessed)")
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def get_key(**request):
+        # the request fields are serialized with sorted keys, so that the key does not depend on the order of the args
+        serialized = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached response or `None` if the response is not in the cache.
+        """
+        with self.transaction() as conn:
+            row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                return None
+
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        serialized = json.dumps(response, ensure_ascii=False)
+
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, serialized, len(serialized.encode("utf-8")), time.time()),
+            )
+            self.evict(conn)
+
+    def evict(self, conn):
+        total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        if total_size <= self.max_size:
+            return
+
+        evicted = 0
+
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            if total_size <= self.max_size:
+                break
+
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total_size -= size
+            evicted += 1
+
+        logger.info(f"Evicted {evicted} responses from the response cache")
+
+    def get_stats(self):
+        conn = self.connect()
+        try:
+            count, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        finally:
+            conn.close()
+
+        return {"count": count, "size": size, "max_size": self.max_size}
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Return the response cache shared within the process.
+    """
+    global response_cache
+
+    with response_cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache()
+
+    return response_cache
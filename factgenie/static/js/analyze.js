@@ -119,6 +119,41 @@ function populateTable(tableId, data, columns) {
     $(`#${tableId}`).bootstrapTable();
 }
 
+const campaignRows = {};
+const campaignRowsPageSize = 10000;
+
+function fetchCampaignRows(campaignId) {
+    // load the (dataset, split, setup_id) rows of the finished examples page by page, the rows are cached
+    if (campaignRows[campaignId] !== undefined) {
+        return Promise.resolve(campaignRows[campaignId]);
+    }
+    const source = campaigns[campaignId].metadata.source;
+    var rows = [];
+
+    function fetchPage(offset) {
+        return $.get(`${url_prefix}/campaigns/examples`, {
+            campaign: campaignId,
+            source: source,
+            columns: "dataset,split,setup_id",
+            status: "finished",
+            offset: offset,
+            limit: campaignRowsPageSize,
+        }).then(function (response) {
+            if (response.error !== undefined) {
+                return Promise.reject(response.error);
+            }
+            rows = rows.concat(response.rows);
+
+            if (rows.length < response.total && response.rows.length > 0) {
+                return fetchPage(offset + response.rows.length);
+            }
+            campaignRows[campaignId] = rows;
+            return rows;
+        });
+    }
+    return fetchPage(0);
+}
+
 function updateComparisonData() {
     const selectedCampaigns = getSelectedCampaigns();
 
@@ -142,14 +177,24 @@ function updateComparisonData() {
     );
 
     // find examples that are common to all selected campaigns and that have a status `finished`
-    const combinations = selectedCampaigns.map(c => campaigns[c].data);
+    Promise.all(selectedCampaigns.map(c => fetchCampaignRows(c))).then(function (combinations) {
+        // the selection may have changed while the rows were loading
+        if (getSelectedCampaigns().join() !== selectedCampaigns.join()) {
+            return;
+        }
+        showComparisonData(combinations);
+    }).catch(function (error) {
+        alert(`Error while loading the campaign examples: ${error}`);
+    });
+}
+
+function showComparisonData(combinations) {
     const commonExamples = combinations.reduce((acc, val) => {
         return acc.filter(x => val.some(y => y.dataset === x.dataset && y.split === x.split && y.setup_id === x.setup_id));
     });
-    const finishedExamples = commonExamples.filter(e => e.status === 'finished');
 
     // for every (dataset, split, setup_id) combination, compute the number of examples
-    const exampleCounts = finishedExamples.reduce((acc, val) => {
+    const exampleCounts = commonExamples.reduce((acc, val) => {
         const key = `${val.dataset}|${val.split}|${val.setup_id}`;
         acc[key] = (acc[key] || 0) + 1;
         return acc;
@@ -172,10 +217,8 @@ function updateComparisonData() {
         ).join("\n")
     );
 
-    $('#common-examples').html(finishedExamples.length);
+    $('#common-examples').html(commonExamples.length);
     $("#agreement-btn").removeClass("disabled");
-
-    return combinations;
 }
 
 
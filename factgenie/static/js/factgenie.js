@@ -81,30 +81,49 @@ function goToPage(page) {
 }
 
 
-function fetchAnnotation(dataset, split, example_idx, annotation_idx) {
+function fetchAnnotations() {
+    // fetch all the examples of the batch in a single request
+    const annotation_idxs = Object.keys(annotation_set);
+    const examples = annotation_idxs.map(annotation_idx => ({
+        "dataset": annotation_set[annotation_idx].dataset,
+        "split": annotation_set[annotation_idx].split,
+        "example_idx": annotation_set[annotation_idx].example_idx,
+    }));
+
     return new Promise((resolve, reject) => {
-        // console.log(`fetching ${dataset} ${split} ${example_idx}`);
-        $.get(`${url_prefix}/example`, {
-            "dataset": dataset,
-            "example_idx": example_idx,
-            "split": split,
-        }, function (data) {
-            $('<div>', {
-                id: `out-text-${annotation_idx}`,
-                class: `annotate-box `,
-                style: 'display: none;'
-            }).appendTo('#outputarea');
-
-            // filter the data to only include the setup we want
-            const setup_id = annotation_set[annotation_idx].setup_id;
-
-            data.generated_outputs = data.generated_outputs.filter(o => o.setup_id == setup_id)[0];
-
-            examples_cached[annotation_idx] = data;
-
-            resolve();
-        }).fail(function () {
-            reject();
+        $.post({
+            url: `${url_prefix}/examples`,
+            contentType: 'application/json',
+            data: JSON.stringify({
+                examples: examples,
+                annotations: false,
+            }),
+            success: function (response) {
+                if (response.error !== undefined) {
+                    reject(response.error);
+                    return;
+                }
+                annotation_idxs.forEach((annotation_idx, i) => {
+                    const data = response.examples[i];
+
+                    $('<div>', {
+                        id: `out-text-${annotation_idx}`,
+                        class: `annotate-box `,
+                        style: 'display: none;'
+                    }).appendTo('#outputarea');
+
+                    // filter the data to only include the setup we want
+                    const setup_id = annotation_set[annotation_idx].setup_id;
+
+                    data.generated_outputs = data.generated_outputs.filter(o => o.setup_id == setup_id)[0];
+
+                    examples_cached[annotation_idx] = data;
+                });
+                resolve();
+            },
+            error: function () {
+                reject();
+            }
         });
     });
 }
@@ -112,18 +131,10 @@ function fetchAnnotation(dataset, split, example_idx, annotation_idx) {
 function loadAnnotations() {
     $("#dataset-spinner").show();
 
-    const promises = [];
     const annotation_span_categories = metadata.config.annotation_span_categories;
 
     // prefetch the examples for annotation: we need them for YPet initialization
-    for (const [annotation_idx, example] of Object.entries(annotation_set)) {
-        const dataset = example.dataset;
-        const split = example.split;
-        const example_idx = example.example_idx;
-        const promise = fetchAnnotation(dataset, split, example_idx, annotation_idx);
-        promises.push(promise);
-    }
-    Promise.all(promises)
+    fetchAnnotations()
         .then(() => {
             YPet.addInitializer(function (options) {
                 /* Configure the # and colors of Annotation types (minimum 1 required) */
@@ -565,11 +576,20 @@ function showSelectedCampaigns() {
 }
 
 function fetchExample(dataset, split, example_idx) {
-    $.get(`${url_prefix}/example`, {
+    const params = {
         "dataset": dataset,
         "example_idx": example_idx,
         "split": split,
-    }, function (data) {
+    };
+    // the annotations are loaded only for the displayed example
+    $.when(
+        $.get(`${url_prefix}/example`, { ...params, "annotations": false }),
+        $.get(`${url_prefix}/annotations`, params)
+    ).done(function (exampleResponse, annotationsResponse) {
+        const data = exampleResponse[0];
+        // the annotations are grouped by the `setup_id` of the outputs, the server compares the slugified ids
+        const annotations = annotationsResponse[0];
+
         $("#dataset-spinner").hide();
         $("#examplearea").html(data.html);
         showRawData(data);
@@ -577,6 +597,13 @@ function fetchExample(dataset, split, example_idx) {
         total_examples = data.total_examples;
         $("#total-examples").html(total_examples - 1);
 
+        if (annotations.error !== undefined) {
+            console.log(annotations.error);
+        }
+        for (const output of data.generated_outputs) {
+            output.annotations = annotations[output.setup_id] || [];
+        }
+
         createOutputBoxes(data.generated_outputs);
         showSelectedCampaigns();
         updateDisplayedAnnotations();
@@ -876,10 +903,59 @@ function createHumanCampaign() {
 }
 
 
+function showLLMCampaignIdle(status) {
+    $("#metadata-status").html(status);
+    $("#run-button").show();
+    $("#stop-button").hide();
+    $("#cancel-button").hide();
+    $("#download-button").show();
+    $("#llm-progress").hide();
+}
+
 function startLLMCampaignListener(campaignId) {
+    if (window.llm_source) {
+        return;
+    }
     var source = new EventSource(`${url_prefix}/llm_campaign/progress/${campaignId}`);
+    window.llm_source = source;
     console.log("Listening for progress events");
 
+    // state changes of the background job running the campaign
+    source.addEventListener("job", function (event) {
+        const job = JSON.parse(event.data);
+        console.log(`Job ${job.id}: ${job.status}`);
+
+        if (job.status == "pausing") {
+            // the examples in flight are still being collected
+            $("#metadata-status").html("pausing");
+            return;
+        }
+        if (job.status == "running" || job.status == "queued") {
+            return;
+        }
+        source.close();
+        window.llm_source = null;
+
+        if (job.message) {
+            $("#log-area").text(job.message);
+        }
+
+        if (job.status == "finished" && job.campaign_status == "finished") {
+            $("#metadata-status").html("finished");
+            $("#run-button").hide();
+            $("#download-button").show();
+            $("#stop-button").hide();
+            $("#cancel-button").hide();
+            $("#llm-progress").hide();
+
+            if (window.mode == "llm_gen") {
+                $("#save-generations-button").show();
+            }
+        } else {
+            showLLMCampaignIdle(job.status == "failed" ? "error" : "idle");
+        }
+    });
+
     source.onmessage = function (event) {
         // update the progress bar
         var payload = JSON.parse(event.data);
@@ -913,36 +989,19 @@ function startLLMCampaignListener(campaignId) {
 
         // update the status
         const status_button = $(`#statusBtn${rowId}`);
-        status_button.text("finished");
-
-        if (progress == 100) {
-            source.close();
-            console.log("Closing the connection");
-
-            $("#metadata-status").html("finished");
-            $("#run-button").hide();
-            $("#download-button").show();
-            $("#stop-button").hide();
-            $("#llm-progress").hide();
-
-            $("#log-area").text(response.final_message);
-
-            if (window.mode == "llm_gen") {
-                $("#save-generations-button").show();
-            }
-        }
-
+        status_button.text(example.status || "finished");
     };
 }
 
 function runLLMCampaign(campaignId) {
     $("#run-button").hide();
     $("#stop-button").show();
+    $("#cancel-button").show();
     $("#llm-progress").show();
     $("#metadata-status").html("running");
+    $("#log-area").text("");
 
-    startLLMCampaignListener(campaignId);
-
+    // the campaign is run in the background, the request returns immediately with the job
     $.post({
         url: `${url_prefix}/llm_campaign/run?mode=${mode}`,
         contentType: 'application/json',
@@ -954,36 +1013,44 @@ function runLLMCampaign(campaignId) {
                 $("#log-area").text(JSON.stringify(response.error));
                 console.log(JSON.stringify(response));
 
-                $("#metadata-status").html("error");
-                $("#run-button").show();
-                $("#stop-button").hide();
-                $("#llm-progress").hide();
+                showLLMCampaignIdle("error");
             } else {
                 console.log(response);
+                window.llm_job_id = response.job.id;
+                startLLMCampaignListener(campaignId);
             }
         }
     });
 }
 
-function pauseLLMCampaign(campaignId) {
-    $("#run-button").show();
-    $("#stop-button").hide();
-    $("#download-button").show();
-    $("#llm-progress").hide();
-    $("#metadata-status").html("idle");
+function updateLLMCampaignJob(campaignId, action) {
+    showLLMCampaignIdle("idle");
 
     $.post({
-        url: `${url_prefix}/llm_campaign/pause?mode=${mode}`,
+        url: `${url_prefix}/llm_campaign/${action}?mode=${mode}`,
         contentType: 'application/json',
         data: JSON.stringify({
-            campaignId: campaignId
+            campaignId: campaignId,
+            jobId: window.llm_job_id
         }),
         success: function (response) {
             console.log(response);
+
+            if (response.success !== true) {
+                $("#log-area").text(JSON.stringify(response.error));
+            }
         }
     });
 }
 
+function pauseLLMCampaign(campaignId) {
+    updateLLMCampaignJob(campaignId, "pause");
+}
+
+function cancelLLMCampaign(campaignId) {
+    updateLLMCampaignJob(campaignId, "cancel");
+}
+
 function addAnnotationSpanCategory() {
     const annotationSpanCategories = $("#annotation-span-categories");
     const randomColor = '#' + Math.floor(Math.random() * 16777215).toString(16);
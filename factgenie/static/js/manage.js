@@ -260,6 +260,55 @@ function detailFormatter(index, row) {
 }
 
 
+function campaignIdFormatter(value, row) {
+    const metadata = row.metadata;
+    const img = `<img src="${url_prefix}/static/img/${metadata.source}.png" style="max-width: 18px;" class="heading-img-inline">`;
+
+    if (metadata.source == 'external') {
+        return `${img} ${$('<span>').text(metadata.id).html()}`;
+    }
+    const link = $('<a>', {
+        href: `${url_prefix}/${metadata.source}/detail?campaign=${encodeURIComponent(metadata.id)}`,
+        class: "blue-link",
+    }).text(metadata.id);
+
+    return `${img} ${link.prop('outerHTML')}`;
+}
+
+function campaignSourceFormatter(value, row) {
+    return row.metadata.source;
+}
+
+function campaignCreatedFormatter(value, row) {
+    return row.metadata.created;
+}
+
+function campaignLabelsFormatter(value, row) {
+    const categories = (row.metadata.config || {}).annotation_span_categories || [];
+
+    // the color is set through .css(), which drops the values that are not valid colors
+    return categories.map(category =>
+        $('<span>', { class: "badge" })
+            .css({ "background-color": category.color, "color": "rgb(60, 65, 73)" })
+            .text(category.name)
+            .prop('outerHTML')
+    ).join("\n");
+}
+
+function campaignStatsFormatter(value, row) {
+    return Object.entries(row.stats).map(([status, count]) =>
+        `<span class="badge bg-secondary">${status}: ${count}</span>`
+    ).join("\n");
+}
+
+function campaignActionsFormatter(value, row) {
+    return `<a onclick="deleteCampaign('${row.metadata.id}', '${row.metadata.source}')"
+        class="btn btn-outline-danger" data-bs-toggle="tooltip" title="Delete the campaign">
+        <i class="fa fa-trash"></i>
+    </a>`;
+}
+
+
 function enableTooltips() {
     // enable tooltips
     var tooltipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'))
@@ -9,12 +9,14 @@ from typing import Dict
 import pandas as pd
 import random
 import time
+import threading
 import coloredlogs
 import traceback
 import yaml
 import queue
 import shutil
 import inspect
+import multiprocessing
 import importlib
 import zipfile
 import markdown
@@ -26,7 +28,8 @@ from tqdm import tqdm
 from io import BytesIO
 from slugify import slugify
 from flask import jsonify, make_response
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 from factgenie.campaigns import (
     HumanCampaign,
@@ -34,8 +37,11 @@ from factgenie.campaigns import (
     ExternalCampaign,
     LLMCampaignGen,
     CampaignStatus,
+    CampaignStorage,
     ExampleStatus,
+    SQLiteCampaignDB,
 )
+from factgenie.annotation_index import get_annotation_index
 from jinja2 import Template
 
 from factgenie import (
@@ -78,6 +84,51 @@ class MessageAnnouncer:
                 del self.listeners[i]
 
 
+class RenderCache:
+    """
+    Bounded LRU cache of the rendered HTML of the examples.
+
+    The keys are (dataset_id, split, example_idx, render_version), the version changes with each new instance of
+    the dataset, so that reloaded datasets are never served stale HTML.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            html = self.cache.get(key)
+
+            if html is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return html
+
+    def put(self, key, html):
+        with self.lock:
+            self.cache[key] = html
+            self.cache.move_to_end(key)
+
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def invalidate(self, dataset_id):
+        with self.lock:
+            for key in [key for key in self.cache if key[0] == dataset_id]:
+                del self.cache[key]
+
+    def get_stats(self):
+        with self.lock:
+            return {"size": len(self.cache), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
 def format_sse(data: str, event=None) -> str:
     """Formats a string and an event name in order to follow the event stream convention.
 
@@ -105,6 +156,19 @@ def get_dataset(app, dataset_id):
     return app.db["datasets_obj"].get(dataset_id)
 
 
+def get_loading_datasets(app, campaign):
+    """
+    Return the datasets of the campaign which are still being loaded in the background.
+    """
+    loading = app.db.get("datasets_loading", set())
+
+    # the campaign db is not needed in the common case when all the datasets are loaded
+    if not loading:
+        return []
+
+    return sorted(loading & set(campaign.db["dataset"].unique()))
+
+
 def load_configs(mode):
     """
     Goes through all the files in the LLM_CONFIG_DIR
@@ -139,9 +203,11 @@ def load_configs(mode):
 
 def load_campaign(app, campaign_id, mode):
     campaign_index = generate_campaign_index(app, force_reload=False)
+    campaign = campaign_index[mode].get(campaign_id)
 
-    if campaign_id in campaign_index[mode]:
-        return campaign_index[mode][campaign_id]
+    # reload the campaign only if it was modified outside of the app
+    if campaign is not None and not campaign.is_outdated():
+        return campaign
 
     if mode == "llm_eval":
         campaign = LLMCampaignEval(campaign_id=campaign_id)
@@ -152,119 +218,136 @@ def load_campaign(app, campaign_id, mode):
 
     campaign_index[mode][campaign_id] = campaign
 
+    with app.db["campaign_index_lock"]:
+        app.db["campaign_index_reloads"] = app.db.get("campaign_index_reloads", 0) + 1
+
     return campaign
 
 
 def generate_campaign_index(app, force_reload=True):
+    """
+    Return the index of campaigns ({source: {campaign_id: campaign}}).
+
+    With `force_reload`, the index is synchronized with the campaign directories: new campaigns are loaded, removed
+    campaigns are dropped and the campaigns are reloaded only if their files were modified outside of the app.
+    """
     if not force_reload and "campaign_index" in app.db:
         return app.db["campaign_index"]
 
-    campaigns = defaultdict(dict)
-
-    # find all subdirs in CROWDSOURCING_DIR
-    for directory in [ANNOTATIONS_DIR, GENERATIONS_DIR]:
-        for campaign_dir in Path(directory).iterdir():
-            try:
-                if not campaign_dir.is_dir():
-                    continue
-
-                metadata = json.load(open(campaign_dir / "metadata.json"))
-                campaign_source = metadata.get("source")
-                campaign_id = metadata["id"]
-
-                if campaign_source == "crowdsourcing":
-                    campaign = HumanCampaign(campaign_id=campaign_id)
-                elif campaign_source == "llm_eval":
-                    campaign = LLMCampaignEval(campaign_id=campaign_id)
-                elif campaign_source == "llm_gen":
-                    campaign = LLMCampaignGen(campaign_id=campaign_id)
-                elif campaign_source == "external":
-                    campaign = ExternalCampaign(campaign_id=campaign_id)
-                elif campaign_source == "hidden":
-                    continue
-                else:
-                    logger.warning(f"Unknown campaign source: {campaign_source}")
-                    continue
-
-                campaigns[campaign_source][campaign_id] = campaign
-            except:
-                traceback.print_exc()
-                logger.error(f"Error while loading campaign {campaign_dir}")
-
-    app.db["campaign_index"] = campaigns
+    with app.db["campaign_index_lock"]:
+        old_campaigns = {
+            os.path.normpath(campaign.dir): campaign
+            for source_campaigns in app.db.get("campaign_index", {}).values()
+            for campaign in source_campaigns.values()
+        }
+        campaigns = defaultdict(dict)
+
+        # find all subdirs in CROWDSOURCING_DIR
+        for directory in [ANNOTATIONS_DIR, GENERATIONS_DIR]:
+            for campaign_dir in Path(directory).iterdir():
+                try:
+                    if not campaign_dir.is_dir():
+                        continue
+
+                    campaign = old_campaigns.get(os.path.normpath(campaign_dir))
+
+                    if campaign is not None and not campaign.is_outdated():
+                        campaigns[campaign.metadata["source"]][campaign.campaign_id] = campaign
+                        continue
+
+                    metadata = json.load(open(campaign_dir / "metadata.json"))
+                    campaign_source = metadata.get("source")
+                    campaign_id = metadata["id"]
+
+                    if campaign_source == "crowdsourcing":
+                        campaign = HumanCampaign(campaign_id=campaign_id)
+                    elif campaign_source == "llm_eval":
+                        campaign = LLMCampaignEval(campaign_id=campaign_id)
+                    elif campaign_source == "llm_gen":
+                        campaign = LLMCampaignGen(campaign_id=campaign_id)
+                    elif campaign_source == "external":
+                        campaign = ExternalCampaign(campaign_id=campaign_id)
+                    elif campaign_source == "hidden":
+                        continue
+                    else:
+                        logger.warning(f"Unknown campaign source: {campaign_source}")
+                        continue
+
+                    app.db["campaign_index_reloads"] = app.db.get("campaign_index_reloads", 0) + 1
+                    campaigns[campaign_source][campaign_id] = campaign
+                except:
+                    traceback.print_exc()
+                    logger.error(f"Error while loading campaign {campaign_dir}")
+
+        logger.debug(f"Campaign index synchronized, {app.db.get('campaign_index_reloads', 0)} campaign loads in total")
+        app.db["campaign_index"] = campaigns
 
     return app.db["campaign_index"]
 
 
-def get_sorted_campaign_list(app, sources):
+def get_sorted_campaign_list(app, sources, sort_by="created", order="desc", search=None):
+    """
+    Return the campaigns from `sources` sorted by a metadata field.
+
+    Only the metadata and the stats are included, the examples of a campaign can be retrieved with
+    `get_campaign_examples()`.
+    """
     campaign_index = generate_campaign_index(app, force_reload=True)
 
     campaigns = []
     for source in sources:
         campaigns.extend(campaign_index[source].values())
 
-    campaigns.sort(key=lambda x: x.metadata["created"], reverse=True)
-    campaigns = {
-        c.metadata["id"]: {"metadata": c.metadata, "stats": c.get_stats(), "data": c.db.to_dict(orient="records")}
-        for c in campaigns
-    }
+    if search:
+        campaigns = [c for c in campaigns if search.lower() in c.metadata["id"].lower()]
+
+    campaigns.sort(key=lambda x: str(x.metadata.get(sort_by, "")), reverse=(order == "desc"))
+    campaigns = {c.metadata["id"]: {"metadata": c.metadata, "stats": c.get_stats()} for c in campaigns}
     return campaigns
 
 
-def load_annotations_for_campaign(subdir):
-    annotations_campaign = defaultdict(list)
+def get_campaign_list_page(app, sources, offset=0, limit=None, sort_by="created", order="desc", search=None):
+    campaigns = get_sorted_campaign_list(app, sources=sources, sort_by=sort_by, order=order, search=search)
+    rows = list(campaigns.values())
 
-    # find metadata for the campaign
-    metadata_path = ANNOTATIONS_DIR / subdir / "metadata.json"
-    if not metadata_path.exists():
-        return None
+    end = offset + limit if limit is not None else None
 
-    with open(metadata_path) as f:
-        metadata = json.load(f)
+    return {"total": len(rows), "rows": rows[offset:end]}
 
-    if metadata["source"] == "hidden":
-        return None
 
-    jsonl_files = (ANNOTATIONS_DIR / subdir / "files").glob("*.jsonl")
+def get_campaign_examples(campaign, offset=0, limit=None, filters=None, columns=None):
+    """
+    Return a page of rows from the campaign db, optionally filtered by column values (e.g. `{"status": "finished"}`).
+    """
+    db = campaign.db
 
-    for jsonl_file in jsonl_files:
-        with open(jsonl_file) as f:
-            for line in f:
-                annotation = json.loads(line)
-                annotation["metadata"] = metadata
+    if filters:
+        mask = pd.Series(True, index=db.index)
 
-                key = (
-                    slugify(annotation["dataset"]),
-                    slugify(annotation["split"]),
-                    annotation["example_idx"],
-                    slugify(annotation["setup_id"]),
-                )
-                annotations_campaign[key].append(annotation)
+        for col, value in filters.items():
+            if col not in db.columns:
+                continue
+            # the values from the query string are strings
+            mask &= db[col].astype(str) == str(value)
 
-    return annotations_campaign
+        db = db[mask]
 
+    if columns:
+        db = db[[col for col in columns if col in db.columns]]
 
-def generate_annotation_index(app):
-    # contains annotations for each generated output
-    annotations = defaultdict(list)
+    end = offset + limit if limit is not None else None
+    page = db.iloc[offset:end]
+    page = page.astype(object).where(pd.notnull(page), "")
 
-    # for all subdirectories in ANNOTATIONS_DIR, load content of all the jsonl files
-    for subdir in os.listdir(ANNOTATIONS_DIR):
-        try:
-            annotations_campaign = load_annotations_for_campaign(subdir)
+    return {"total": len(db), "rows": page.to_dict(orient="records")}
 
-            if annotations_campaign is None:
-                continue
 
-            for key, annotation_set in annotations_campaign.items():
-                annotations[key].extend(annotation_set)
-        except:
-            # if app.config["debug"]:
-            traceback.print_exc()
-            logger.error(f"Error while loading annotations for {subdir}")
+def generate_annotation_index(app):
+    # index the annotations added since the last update (e.g. by other processes)
+    annotation_index = app.db["annotation_index"]
+    annotation_index.sync()
 
-    app.db["annotation_index"] = annotations
-    return annotations
+    return annotation_index
 
 
 def export_campaign_outputs(app, mode, campaign_id):
@@ -288,30 +371,57 @@ def export_campaign_outputs(app, mode, campaign_id):
     return response
 
 
-def get_annotations(app, dataset_id, split, example_idx, setup_id):
+def get_annotations(app, dataset_id, split, example_idx, setup_id=None, campaign_id=None, categories=None):
     annotation_index = app.db["annotation_index"]
-    key = (slugify(dataset_id), slugify(split), example_idx, slugify(setup_id))
 
-    return annotation_index.get(key, [])
+    return annotation_index.get_annotations(
+        dataset_id, split, example_idx, setup_id=setup_id, campaign_id=campaign_id, categories=categories
+    )
+
+
+def get_annotations_by_setup(app, dataset_id, split, example_idx, campaign_id=None, categories=None):
+    """
+    Return the annotations of the example grouped by the `setup_id` of its outputs.
+
+    The annotations are matched to the outputs on their slugified setup ids (same as in the annotation index).
+    """
+    annotations = get_annotations(app, dataset_id, split, example_idx, campaign_id=campaign_id, categories=categories)
+    grouped = defaultdict(list)
+
+    for annotation in annotations:
+        grouped[slugify(str(annotation["setup_id"]))].append(annotation)
+
+    dataset = get_dataset(app=app, dataset_id=dataset_id)
+    outputs = dataset.get_outputs_for_idx(split=split, output_idx=example_idx)
+
+    return {output["setup_id"]: grouped.get(slugify(str(output["setup_id"])), []) for output in outputs}
 
 
-def get_example_data(app, dataset_id, split, example_idx):
+def get_example_data(app, dataset_id, split, example_idx, with_annotations=True):
     dataset = get_dataset(app=app, dataset_id=dataset_id)
 
     example = dataset.get_example(split=split, example_idx=example_idx)
-    html = dataset.render(example=example)
 
-    # temporary solution for external files
-    # prefix all the "/files" calls with "app.config["host_prefix"]"
-    html = html.replace('src="/files', f'src="{app.config["host_prefix"]}/files')
+    render_cache = app.db["render_cache"]
+    cache_key = (dataset_id, split, example_idx, dataset.render_version)
+    html = render_cache.get(cache_key)
+
+    if html is None:
+        html = dataset.render(example=example)
+
+        # temporary solution for external files
+        # prefix all the "/files" calls with "app.config["host_prefix"]"
+        html = html.replace('src="/files', f'src="{app.config["host_prefix"]}/files')
+        render_cache.put(cache_key, html)
 
     generated_outputs = dataset.get_outputs_for_idx(split=split, output_idx=example_idx)
 
-    for i, output in enumerate(generated_outputs):
-        setup_id = output["setup_id"]
-        annotations = get_annotations(app, dataset_id, split, example_idx, setup_id)
+    if with_annotations:
+        for i, output in enumerate(generated_outputs):
+            setup_id = output["setup_id"]
+            annotations = get_annotations(app, dataset_id, split, example_idx, setup_id)
 
-        generated_outputs[i]["annotations"] = annotations
+            generated_outputs[i]["annotations"] = annotations
 
     return {
         "html": html,
@@ -345,78 +455,53 @@ def get_model_outputs_overview(app, datasets, non_empty=False):
     return model_outputs
 
 
-def free_idle_examples(db):
-    start = int(time.time())
-
-    # check if there are annotations which are idle for more than 2 hours: set them to free
-    idle_examples = db[(db["status"] == ExampleStatus.ASSIGNED) & (db["start"] < start - 2 * 60 * 60)]
-    for i in idle_examples.index:
-        db.loc[i, "status"] = ExampleStatus.FREE
-        db.loc[i, "start"] = ""
-        db.loc[i, "end"] = ""
-        db.loc[i, "annotator_id"] = ""
+def get_campaign_lock(app, campaign_id):
+    # the global lock only guards the lock registry
+    with app.db["lock"]:
+        if campaign_id not in app.db["campaign_locks"]:
+            app.db["campaign_locks"][campaign_id] = threading.Lock()
 
-    return db
+        return app.db["campaign_locks"][campaign_id]
 
 
-def select_batch_idx(db, seed):
-    free_examples = db[db["status"] == ExampleStatus.FREE]
-    assigned_examples = db[db["status"] == ExampleStatus.ASSIGNED]
+def get_annotator_batch(app, campaign, service_ids):
+    annotator_id = service_ids["annotator_id"]
+    start = int(time.time())
+    seed = str(start) + str(service_ids.values())
+    update = annotator_id != PREVIEW_STUDY_ID
 
-    if len(free_examples) == 0 and len(assigned_examples) == 0:
-        raise ValueError("No examples available")
+    if campaign.storage == CampaignStorage.SQLITE:
+        # the batch is selected and assigned in a single transaction, which is safe across processes
+        batch_idx, changed_rows = campaign.assign_batch(annotator_id, start, seed, update=update)
+    else:
+        # only the in-memory state is updated under the lock
+        with get_campaign_lock(app, campaign.campaign_id):
+            db = campaign.db
+            batch_idx, changed_rows = campaign.assign_batch(annotator_id, start, seed, update=update)
 
-    # if no free examples but still assigned examples, take the oldest assigned example
-    if len(free_examples) == 0 and len(assigned_examples) > 0:
-        free_examples = assigned_examples
-        free_examples = free_examples.sort_values(by=["start"])
-        free_examples = free_examples.head(1)
+        if changed_rows:
+            campaign.update_db_rows(db, changed_rows)
 
-        logger.info(f"Annotating extra example {free_examples.index[0]}")
+    if batch_idx is None:
+        # no available batches
+        return []
 
-    example = free_examples.sample(random_state=seed)
-    batch_idx = int(example.batch_idx.values[0])
     logger.info(f"Selecting batch {batch_idx}")
+    annotator_batch = campaign.get_examples_for_batch(batch_idx)
 
-    return batch_idx
-
-
-def get_annotator_batch(app, campaign, db, service_ids):
-    # simple locking over the CSV file to prevent double writes
-    with app.db["lock"]:
-        annotator_id = service_ids["annotator_id"]
-
-        logging.info(f"Acquiring lock for {annotator_id}")
-        start = int(time.time())
-
-        seed = random.seed(str(start) + str(service_ids.values()))
-
-        try:
-            batch_idx = select_batch_idx(db, seed)
-        except ValueError:
-            # no available batches
-            return []
-
-        if annotator_id != PREVIEW_STUDY_ID:
-            db = free_idle_examples(db)
-
-            # update the CSV
-            db.loc[db["batch_idx"] == batch_idx, "status"] = ExampleStatus.ASSIGNED
-            db.loc[db["batch_idx"] == batch_idx, "start"] = start
-            db.loc[db["batch_idx"] == batch_idx, "annotator_id"] = annotator_id
-
-            campaign.update_db(db)
-
-        annotator_batch = campaign.get_examples_for_batch(batch_idx)
+    for example in annotator_batch:
+        example.update(
+            {"campaign_id": campaign.campaign_id, "batch_idx": batch_idx, "start_timestamp": start, **service_ids}
+        )
 
-        for example in annotator_batch:
-            example.update(
-                {"campaign_id": campaign.campaign_id, "batch_idx": batch_idx, "start_timestamp": start, **service_ids}
-            )
+    return annotator_batch
 
-        logging.info(f"Releasing lock for {annotator_id}")
 
-    return annotator_batch
+def save_campaign_db(campaign_dir, db, storage=CampaignStorage.CSV):
+    if storage == CampaignStorage.SQLITE:
+        SQLiteCampaignDB(os.path.join(campaign_dir, "db.sqlite")).write(db)
+    else:
+        db.to_csv(os.path.join(campaign_dir, "db.csv"), index=False)
 
 
 def generate_llm_campaign_db(mode, datasets, campaign_id, campaign_data):
@@ -529,15 +614,30 @@ def save_dataset_config(config):
         yaml.dump(config, f, indent=2, allow_unicode=True)
 
 
+def set_dataset_obj(app, dataset_id, dataset):
+    """
+    Store the dataset instance in the app (or remove it with `dataset=None`) and close the instance it replaces.
+    """
+    if dataset is None:
+        previous = app.db["datasets_obj"].pop(dataset_id, None)
+    else:
+        previous = app.db["datasets_obj"].get(dataset_id)
+        app.db["datasets_obj"][dataset_id] = dataset
+
+    if previous is not None and previous is not dataset:
+        previous.close()
+
+
 def set_dataset_enabled(app, dataset_id, enabled):
     config = load_dataset_config()
     config[dataset_id]["enabled"] = enabled
 
     if enabled:
-        dataset = instantiate_dataset(dataset_id, config[dataset_id])
-        app.db["datasets_obj"][dataset_id] = dataset
+        set_dataset_obj(app, dataset_id, instantiate_dataset(dataset_id, config[dataset_id]))
     else:
-        app.db["datasets_obj"].pop(dataset_id, None)
+        set_dataset_obj(app, dataset_id, None)
+
+    app.db["render_cache"].invalidate(dataset_id)
 
     save_dataset_config(config)
 
@@ -554,14 +654,18 @@ def get_local_dataset_overview(app):
         splits = dataset_config.get("splits", [])
         dataset_type = dataset_config.get("type", "default")
 
-        if is_enabled:
+        is_loading = dataset_id in app.db.get("datasets_loading", set())
+
+        if is_enabled and is_loading:
+            example_count = {}
+        elif is_enabled:
             dataset = app.db["datasets_obj"].get(dataset_id)
 
             if dataset is None:
                 logger.warning(f"Dataset {dataset_id} is enabled but not loaded")
                 continue
 
-            dataset.outputs = dataset.load_generated_outputs(dataset.output_path)
+            dataset.refresh_outputs()
 
             example_count = {split: dataset.get_example_count(split) for split in dataset.get_splits()}
         else:
@@ -575,6 +679,7 @@ def get_local_dataset_overview(app):
             "description": description,
             "example_count": example_count,
             "type": dataset_type,
+            "loading": is_loading,
         }
 
     return overview
@@ -624,7 +729,8 @@ def download_dataset(app, dataset_id):
     }
 
     dataset = instantiate_dataset(dataset_id, config[dataset_id])
-    app.db["datasets_obj"][dataset_id] = dataset
+    set_dataset_obj(app, dataset_id, dataset)
+    app.db["render_cache"].invalidate(dataset_id)
 
     save_dataset_config(config)
 
@@ -639,7 +745,8 @@ def delete_dataset(app, dataset_id):
     # remove the data directory
     shutil.rmtree(f"factgenie/data/{dataset_id}", ignore_errors=True)
 
-    app.db["datasets_obj"].pop(dataset_id, None)
+    set_dataset_obj(app, dataset_id, None)
+    app.db["render_cache"].invalidate(dataset_id)
 
 
 def export_dataset(app, dataset_id):
@@ -699,19 +806,73 @@ def instantiate_dataset(dataset_id, dataset_config):
     return dataset_class(dataset_id, **dataset_config)
 
 
-def instantiate_datasets():
+def build_dataset_snapshots(dataset_id, dataset_config, splits):
+    # runs in a worker process, the model outputs are not needed for building the snapshots
+    dataset = instantiate_dataset(dataset_id, {**dataset_config, "load_outputs": False})
+
+    return {split: dataset.load_snapshot(split) for split in splits}
+
+
+def load_dataset(app, dataset_id, dataset_config, process_pool):
+    start = time.time()
+
+    try:
+        dataset = instantiate_dataset(dataset_id, dataset_config)
+
+        # the post-processing is CPU-bound, the missing snapshots are built in the process pool
+        if dataset.use_snapshots and dataset.has_postprocessing():
+            splits = [split for split in dataset.get_splits() if not dataset.has_snapshot(split)]
+
+            if splits:
+                future = process_pool.submit(build_dataset_snapshots, dataset_id, dataset_config, splits)
+
+                # the other splits stay lazy, they are loaded from their snapshots on first access
+                with dataset.examples_lock:
+                    dataset.examples.update(future.result())
+
+        set_dataset_obj(app, dataset_id, dataset)
+        logger.info(f"Dataset {dataset_id} loaded in {time.time() - start:.2f} s")
+    except:
+        traceback.print_exc()
+        logger.error(f"Error while loading dataset {dataset_id} (after {time.time() - start:.2f} s)")
+    finally:
+        app.db["datasets_loading"].discard(dataset_id)
+
+
+def load_datasets_in_background(app):
+    """
+    Instantiate the enabled datasets in parallel without blocking the app startup.
+
+    The datasets are added to `app.db["datasets_obj"]` as they finish, the datasets which are still being loaded are
+    listed in `app.db["datasets_loading"]`.
+    """
     config = load_dataset_config()
-    datasets = {}
+    enabled = {dataset_id: c for dataset_id, c in config.items() if c.get("enabled", True)}
 
-    for dataset_id, dataset_config in config.items():
-        is_enabled = dataset_config.get("enabled", True)
+    app.db["datasets_obj"] = {}
+    app.db["datasets_loading"] = set(enabled.keys())
 
-        if not is_enabled:
-            continue
+    if not enabled:
+        return
 
-        datasets[dataset_id] = instantiate_dataset(dataset_id, dataset_config)
+    # spawned processes do not inherit the threads and locks of the app
+    process_pool = ProcessPoolExecutor(
+        max_workers=min(len(enabled), os.cpu_count() or 1), mp_context=multiprocessing.get_context("spawn")
+    )
+    thread_pool = ThreadPoolExecutor(max_workers=min(len(enabled), 8))
 
-    return datasets
+    futures = [
+        thread_pool.submit(load_dataset, app, dataset_id, dataset_config, process_pool)
+        for dataset_id, dataset_config in enabled.items()
+    ]
+
+    def shutdown():
+        wait(futures)
+        process_pool.shutdown()
+        thread_pool.shutdown()
+        logger.info("All datasets loaded")
+
+    threading.Thread(target=shutdown, daemon=True).start()
 
 
 def upload_dataset(app, dataset_id, dataset_description, dataset_format, dataset_data):
@@ -756,7 +917,8 @@ def upload_dataset(app, dataset_id, dataset_description, dataset_format, dataset
     }
     save_dataset_config(config)
 
-    app.db["datasets_obj"][dataset_id] = instantiate_dataset(dataset_id, config[dataset_id])
+    set_dataset_obj(app, dataset_id, instantiate_dataset(dataset_id, config[dataset_id]))
+    app.db["render_cache"].invalidate(dataset_id)
 
 
 def upload_model_outputs(dataset, split, setup_id, model_outputs):
@@ -766,15 +928,13 @@ def upload_model_outputs(dataset, split, setup_id, model_outputs):
     generated = model_outputs.strip().split("\n")
     setup_id = slugify(setup_id)
 
-    if setup_id in dataset.outputs[split]:
+    if setup_id in dataset.get_outputs_for_split(split):
         raise ValueError(f"Output for {setup_id} already exists in {split}")
 
-    if len(generated) != len(dataset.examples[split]):
-        raise ValueError(
-            f"Output count mismatch for {setup_id} in {split}: {len(generated)} vs {len(dataset.examples[split])}"
-        )
+    example_count = dataset.get_example_count(split)
 
-    dataset.outputs[split][setup_id] = {}
+    if len(generated) != example_count:
+        raise ValueError(f"Output count mismatch for {setup_id} in {split}: {len(generated)} vs {example_count}")
 
     with open(f"{path}/{setup_id}.jsonl", "w") as f:
         for i, out in enumerate(generated):
@@ -787,7 +947,7 @@ def upload_model_outputs(dataset, split, setup_id, model_outputs):
             }
             f.write(json.dumps(j) + "\n")
 
-            dataset.outputs[split][setup_id][i] = j
+    dataset.add_outputs_file(f"{path}/{setup_id}.jsonl")
 
     with open(f"{path.parent}/metadata.json", "w") as f:
         json.dump(
@@ -806,7 +966,7 @@ def delete_model_outputs(dataset, split, setup_id):
     if path.exists():
         shutil.rmtree(path)
 
-    dataset.outputs[split].pop(setup_id, None)
+    dataset.remove_outputs(split, setup_id)
 
 
 def llm_campaign_new(mode, campaign_id, config, campaign_data, datasets, overwrite=False):
@@ -909,11 +1069,23 @@ def save_annotation(annotator_id, campaign_id, dataset_id, split, setup_id, exam
     }
 
     # save the annotation
-    with open(os.path.join(save_dir, f"{annotator_id}-{dataset_id}-{split}-{start_time}.jsonl"), "a") as f:
+    save_path = os.path.join(save_dir, f"{annotator_id}-{dataset_id}-{split}-{start_time}.jsonl")
+    with open(save_path, "a") as f:
         f.write(json.dumps(annotation) + "\n")
+
+    index_annotation_file(save_path)
     return annotation
 
 
+def index_annotation_file(path):
+    try:
+        get_annotation_index().index_file(path)
+    except Exception:
+        # the annotations are indexed again with the next sync
+        traceback.print_exc()
+        logger.error(f"Error while indexing annotations from {path}")
+
+
 def save_output(campaign_id, dataset_id, split, example_idx, output, start_time):
     save_dir = os.path.join(GENERATIONS_DIR, campaign_id, "files")
     os.makedirs(save_dir, exist_ok=True)
@@ -946,10 +1118,15 @@ def duplicate_eval(app, mode, campaign_id, new_campaign_id):
     if os.path.exists(new_campaign_dir):
         return error("Campaign already exists")
 
-    shutil.copytree(old_campaign_dir, new_campaign_dir, ignore=shutil.ignore_patterns("files"))
+    old_campaign = load_campaign(app, campaign_id, mode)
+    shutil.copytree(
+        old_campaign_dir,
+        new_campaign_dir,
+        ignore=shutil.ignore_patterns("files", "db.journal", "db.sqlite*", "stats.json"),
+    )
 
     # copy the db
-    old_db = pd.read_csv(os.path.join(old_campaign_dir, "db.csv"))
+    old_db = old_campaign.db
     new_db = old_db.copy()
     new_db["status"] = ExampleStatus.FREE
 
@@ -958,7 +1135,10 @@ def duplicate_eval(app, mode, campaign_id, new_campaign_id):
     new_db["start"] = ""
     new_db["end"] = ""
 
-    new_db.to_csv(os.path.join(new_campaign_dir, "db.csv"), index=False)
+    if "error" in new_db.columns:
+        new_db["error"] = ""
+
+    save_campaign_db(new_campaign_dir, new_db, storage=old_campaign.storage)
 
     # update the metadata
     metadata_path = os.path.join(new_campaign_dir, "metadata.json")
@@ -968,6 +1148,7 @@ def duplicate_eval(app, mode, campaign_id, new_campaign_id):
     metadata["id"] = new_campaign_id
     metadata["created"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     metadata["status"] = CampaignStatus.IDLE
+    metadata.pop("response_cache", None)
 
     with open(metadata_path, "w") as f:
         json.dump(metadata, f, indent=4)
@@ -1147,78 +1328,242 @@ def create_crowdsourcing_page(campaign_id, config):
         f.write(content)
 
 
-def run_llm_campaign(mode, campaign_id, announcer, campaign, datasets, model, threads):
-    start_time = int(time.time())
+def get_model_output(mode, model, dataset, row, is_running=lambda: True):
+    """
+    Call the model on the example, retrying the calls which failed on a retryable error (see `Model.get_retry_policy()`).
+    """
+    split = row["split"]
+    example_idx = row["example_idx"]
+    example = dataset.get_example(split, example_idx)
+    retry_policy = model.get_retry_policy()
 
-    # set metadata status
-    campaign.metadata["status"] = CampaignStatus.RUNNING
-    campaign.update_metadata()
-    db = campaign.db
+    if mode == "llm_eval":
+        generated_output = dataset.get_output_for_idx_by_setup(
+            split=split, output_idx=example_idx, setup_id=row.get("setup_id")
+        )
 
-    logger.info(f"Starting LLM campaign {campaign_id}")
+    for attempt in range(retry_policy.max_attempts):
+        if mode == "llm_eval":
+            output = model.annotate_example(example, generated_output)
+        elif mode == "llm_gen":
+            output = model.generate_output(example)
 
-    for i, row in db.iterrows():
-        if threads[campaign_id]["running"] == False:
+        if not (isinstance(output, dict) and output.get("retryable")):
+            return output
+
+        if attempt + 1 == retry_policy.max_attempts or not is_running():
             break
 
-        if row["status"] == ExampleStatus.FINISHED:
-            continue
+        delay = retry_policy.get_delay(attempt)
+        logger.warning(
+            f"Retrying example {example_idx} in {delay:.1f} s "
+            f"({attempt + 1}/{retry_policy.max_attempts}): {output['error']}"
+        )
+        time.sleep(delay)
 
-        dataset_id = row["dataset"]
-        split = row["split"]
-        setup_id = row.get("setup_id")
-        example_idx = row["example_idx"]
+    return output
 
-        dataset = datasets[dataset_id]
-        example = dataset.get_example(split, example_idx)
 
-        if mode == "llm_eval":
-            generated_output = dataset.get_output_for_idx_by_setup(
-                split=split, output_idx=example_idx, setup_id=setup_id
-            )
-            output = model.annotate_example(example, generated_output)
+class CircuitBreaker:
+    """
+    Stops a campaign after `threshold` consecutive examples failed, a single failure is not worth stopping for.
+    """
 
-        elif mode == "llm_gen":
-            output = model.generate_output(example)
+    def __init__(self, threshold=5):
+        self.threshold = threshold
+        self.failures = 0
 
-        if "error" in output:
-            # remove the `running` flag
-            threads[campaign_id]["running"] = False
-            campaign.metadata["status"] = CampaignStatus.IDLE
-            campaign.update_metadata()
+    def record_success(self):
+        self.failures = 0
 
-            return error(output["error"])
+    def record_failure(self):
+        self.failures += 1
 
-        if mode == "llm_eval":
-            annotator_id = model.get_annotator_id()
+    def is_open(self):
+        return self.failures >= self.threshold
 
-            record = save_annotation(
-                annotator_id, campaign_id, dataset_id, split, setup_id, example_idx, output, start_time
-            )
-            record["output"] = record.pop("annotations")
-        elif mode == "llm_gen":
-            record = save_output(campaign_id, dataset_id, split, example_idx, output, start_time)
 
-            # solely for the frontend
-            record["setup_id"] = setup_id
-            record["output"] = record.pop("out")
+def get_int_extra_arg(extra_args, name, default):
+    # the values of `extra_args` set in the web interface are strings, an empty value means the argument is not set
+    value = extra_args.get(name)
+
+    if value is None or value == "":
+        return default
+
+    return int(value)
+
+
+def run_llm_campaign(mode, campaign_id, announcer, campaign, datasets, model, threads):
+    """
+    Run the model on the examples of the campaign which are not finished yet.
+
+    The campaign is stopped when `threads[campaign_id]["running"]` is cleared. Returns a dict with `success` and
+    either `final_message` or `error`.
+    """
+    start_time = int(time.time())
+
+    # e.g. a dataset which failed to load or was disabled after the campaign was created
+    missing_datasets = sorted(set(campaign.db["dataset"].unique()) - set(datasets.keys()))
+
+    if missing_datasets:
+        return {"success": False, "error": f"The datasets {', '.join(missing_datasets)} are not available."}
+
+    # number of examples processed in parallel, can be set in the `extra_args` of the campaign config
+    extra_args = campaign.metadata["config"].get("extra_args") or {}
+    max_concurrency = max(1, get_int_extra_arg(extra_args, "max_concurrency", default=1))
+    circuit_breaker = CircuitBreaker(
+        threshold=max(1, get_int_extra_arg(extra_args, "circuit_breaker_threshold", default=5))
+    )
+
+    # set metadata status
+    campaign.metadata["status"] = CampaignStatus.RUNNING
+    campaign.update_metadata()
+    db = campaign.db
+
+    logger.info(f"Starting LLM campaign {campaign_id} ({max_concurrency=})")
+
+    # examples that were already finished are skipped
+    # (`iterrows()` yields Python scalars, `db.loc[i]` would yield numpy scalars which are not JSON serializable)
+    todo = db[db["status"] != ExampleStatus.FINISHED].iterrows()
+    pending = {}
+    error_output = None
+    failed_cnt = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            while True:
+                # keep at most `max_concurrency` requests in flight so that pausing takes effect quickly
+                while threads[campaign_id]["running"] and len(pending) < max_concurrency:
+                    i, row = next(todo, (None, None))
+                    if i is None:
+                        break
+
+                    dataset = datasets[row["dataset"]]
+                    future = executor.submit(
+                        get_model_output, mode, model, dataset, row, lambda: threads[campaign_id]["running"]
+                    )
+                    pending[future] = (i, row)
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    i, row = pending.pop(future)
+
+                    try:
+                        output = future.result()
+                    except Exception as e:
+                        traceback.print_exc()
+                        output = {"error": str(e), "retryable": False}
+
+                    dataset_id = row["dataset"]
+                    split = row["split"]
+                    setup_id = row.get("setup_id")
+                    example_idx = row["example_idx"]
+
+                    if isinstance(output, dict) and "error" in output:
+                        circuit_breaker.record_failure()
+                        failed_cnt += 1
+
+                        if circuit_breaker.is_open() and threads[campaign_id]["running"]:
+                            # remove the `running` flag, the requests in flight are still collected
+                            threads[campaign_id]["running"] = False
+                            error_output = {
+                                "error": f"The campaign was paused after {circuit_breaker.failures} consecutive failed "
+                                f"examples. Last error: {output['error']}"
+                            }
+
+                        if output.get("retryable"):
+                            # the example stays free and is processed again when the campaign is resumed
+                            logger.warning(f"{campaign_id}: giving up on example {example_idx}: {output['error']}")
+                            continue
+
+                        db.loc[i, ["status", "end", "error"]] = [ExampleStatus.ERROR, int(time.time()), output["error"]]
+                        campaign.update_db_rows(db, [i])
+
+                        record = {
+                            "dataset": dataset_id,
+                            "split": split,
+                            "setup_id": setup_id,
+                            "example_idx": example_idx,
+                            "status": ExampleStatus.ERROR,
+                            "output": output["error"],
+                        }
+                        payload = {"finished_examples_cnt": campaign.get_finished_count(), "annotation": record}
+
+                        if announcer is not None:
+                            announcer.announce(msg=format_sse(data=json.dumps(payload, default=str)))
+                        continue
+
+                    circuit_breaker.record_success()
+
+                    if mode == "llm_eval":
+                        annotator_id = model.get_annotator_id()
+
+                        record = save_annotation(
+                            annotator_id, campaign_id, dataset_id, split, setup_id, example_idx, output, start_time
+                        )
+                        record["output"] = record.pop("annotations")
+                    elif mode == "llm_gen":
+                        record = save_output(campaign_id, dataset_id, split, example_idx, output, start_time)
+
+                        # solely for the frontend
+                        record["setup_id"] = setup_id
+                        record["output"] = record.pop("out")
+
+                    db.loc[i, "status"] = ExampleStatus.FINISHED
+                    db.loc[i, "end"] = int(time.time())
+                    db.loc[i, "error"] = ""
+                    campaign.update_db_rows(db, [i])
+
+                    finished_examples_cnt = campaign.get_finished_count()
+                    payload = {"finished_examples_cnt": finished_examples_cnt, "annotation": record}
+
+                    msg = format_sse(data=json.dumps(payload))
+                    if announcer is not None:
+                        announcer.announce(msg=msg)
+                    logger.info(f"{campaign_id}: {finished_examples_cnt}/{len(db)} examples")
+    except Exception:
+        # do not leave the campaign marked as running
+        campaign.metadata["status"] = CampaignStatus.IDLE
+        campaign.update_metadata()
+        raise
+
+    # compact the journal so that `db.csv` reflects the current state
+    campaign.update_db(db)
+
+    if model.use_response_cache():
+        # the hits and misses of the response cache are accumulated over the runs of the campaign
+        cache_stats = campaign.metadata.setdefault("response_cache", {"hits": 0, "misses": 0})
+
+        for key, value in model.get_cache_stats().items():
+            cache_stats[key] = cache_stats.get(key, 0) + value
 
-        db.loc[i, "status"] = ExampleStatus.FINISHED
-        db.loc[i, "end"] = int(time.time())
-        campaign.update_db(db)
+        campaign.update_metadata()
 
-        finished_examples_cnt = len(campaign.get_finished_examples())
-        payload = {"finished_examples_cnt": finished_examples_cnt, "annotation": record}
+    if error_output is not None:
+        campaign.metadata["status"] = CampaignStatus.IDLE
+        campaign.update_metadata()
 
-        msg = format_sse(data=json.dumps(payload))
-        if announcer is not None:
-            announcer.announce(msg=msg)
-        logger.info(f"{campaign_id}: {finished_examples_cnt}/{len(db)} examples")
+        return {"success": False, "error": error_output["error"]}
 
     # if all fields are finished, set the metadata to finished
     if len(db.status.unique()) == 1 and db.status.unique()[0] == ExampleStatus.FINISHED:
         campaign.metadata["status"] = CampaignStatus.FINISHED
         campaign.update_metadata()
+    else:
+        # the failed examples and the examples skipped after the campaign was stopped are processed when it is run again
+        campaign.metadata["status"] = CampaignStatus.IDLE
+        campaign.update_metadata()
+
+        if failed_cnt > 0:
+            final_message = f"{failed_cnt} examples could not be processed, run the campaign again to retry them."
+        else:
+            final_message = "The campaign was stopped, run it again to process the remaining examples."
+
+        return {"success": True, "status": campaign.metadata["status"], "final_message": final_message}
 
     if mode == "llm_eval":
         final_message = (
@@ -1229,7 +1574,7 @@ def run_llm_campaign(mode, campaign_id, announcer, campaign, datasets, model, th
             f"All examples have been generated. You can find the outputs in {GENERATIONS_DIR}/{campaign_id}/files."
         )
 
-    return jsonify(success=True, status=campaign.metadata["status"], final_message=final_message)
+    return {"success": True, "status": campaign.metadata["status"], "final_message": final_message}
 
 
 def save_generation_outputs(app, campaign_id, setup_id):
@@ -1266,10 +1611,22 @@ def save_generation_outputs(app, campaign_id, setup_id):
         with open(path / f"metadata.json", "w") as f:
             json.dump(metadata, f, indent=4)
 
-        with open(path / "files" / f"{setup_id}.jsonl", "w") as f:
+        # the existing file may be memory-mapped, it is replaced instead of being overwritten in place
+        out_path = path / "files" / f"{setup_id}.jsonl"
+        tmp_path = path / "files" / f"{setup_id}.jsonl.tmp"
+
+        with open(tmp_path, "w") as f:
             for example in examples:
                 f.write(json.dumps(example) + "\n")
 
+        os.replace(tmp_path, out_path)
+
+        # update the outputs of the loaded dataset
+        dataset = app.db["datasets_obj"].get(dataset_id)
+
+        if dataset is not None:
+            dataset.add_outputs_file(out_path)
+
     return success()
 
 
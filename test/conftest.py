@@ -0,0 +1,17 @@
+import shutil
+from pathlib import Path
+
+CONFIG_DIR = Path(__file__).parent.parent / "factgenie" / "config"
+CONFIG_PATH = CONFIG_DIR / "config.yml"
+
+# `factgenie` cannot be imported without the main config, use the template if the config was not created yet
+created_config = False
+
+if not CONFIG_PATH.exists():
+    shutil.copy(CONFIG_DIR / "config_TEMPLATE.yml", CONFIG_PATH)
+    created_config = True
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if created_config:
+        CONFIG_PATH.unlink(missing_ok=True)
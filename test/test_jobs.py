@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+import factgenie.jobs as jobs
+from factgenie.campaigns import CampaignStatus
+from factgenie.jobs import JobRunner, JobStatus
+
+
+class StubCampaign:
+    def __init__(self):
+        self.metadata = {"config": {}, "status": CampaignStatus.IDLE}
+
+
+class StubApp:
+    def __init__(self):
+        self.db = {"announcers": {}, "threads": {}, "datasets_obj": {}}
+
+
+@pytest.fixture
+def runner(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def run_llm_campaign(mode, campaign_id, announcer, campaign, datasets, model, threads):
+        started.set()
+        # an example in flight, the campaign returns only once it is collected
+        release.wait(timeout=5)
+        return {"success": True, "status": CampaignStatus.IDLE, "final_message": "stopped"}
+
+    monkeypatch.setattr(jobs.utils, "load_campaign", lambda app, campaign_id, mode: StubCampaign())
+    monkeypatch.setattr(jobs.utils, "run_llm_campaign", run_llm_campaign)
+    monkeypatch.setattr(jobs.ModelFactory, "from_config", lambda config, mode: None)
+
+    runner = JobRunner(StubApp(), num_workers=1)
+    runner.started = started
+    runner.release = release
+
+    return runner
+
+
+def wait_for(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+
+    raise AssertionError("Condition not met")
+
+
+def test_pause_waits_for_examples_in_flight(runner):
+    job = runner.submit("llm_eval", "campaign")
+    assert runner.started.wait(timeout=5)
+
+    runner.pause(job)
+    assert job.status == JobStatus.PAUSING
+    assert runner.app.db["threads"]["campaign"]["running"] is False
+
+    runner.release.set()
+    wait_for(lambda: job.status == JobStatus.PAUSED)
+
+    assert job.message == "stopped"
+    assert runner.get_campaign_job("campaign") is job
+
+
+def test_inactive_jobs_are_pruned(runner):
+    runner.release.set()
+
+    for _ in range(jobs.MAX_INACTIVE_JOBS_PER_CAMPAIGN + 5):
+        runner.cancel(runner.submit("llm_eval", "campaign"))
+
+    assert len(runner.get_jobs()) == jobs.MAX_INACTIVE_JOBS_PER_CAMPAIGN
+    assert all(job["status"] == JobStatus.CANCELLED for job in runner.get_jobs())
+
+
+def test_last_job_is_kept_after_it_finished(runner):
+    runner.release.set()
+    job = runner.submit("llm_eval", "campaign")
+    wait_for(lambda: job.status == JobStatus.FINISHED)
+
+    # the state is sent to the clients which connect after the job has finished
+    assert runner.get_campaign_job("campaign") is None
+    assert runner.get_last_campaign_job("campaign") is job
@@ -0,0 +1,162 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import factgenie.annotation_index as annotation_index
+import factgenie.campaigns as campaigns
+import factgenie.utils as utils
+from factgenie.annotation_index import AnnotationIndex
+from factgenie.campaigns import CampaignStatus, ExampleStatus, LLMCampaignEval
+from factgenie.models import RetryPolicy
+
+
+class StubDataset:
+    def get_example(self, split, example_idx):
+        return {"idx": example_idx}
+
+    def get_output_for_idx_by_setup(self, split, output_idx, setup_id):
+        return f"output {output_idx}"
+
+
+class StubModel:
+    def __init__(self, fail_on=()):
+        self.fail_on = fail_on
+
+    def annotate_example(self, data, text):
+        if data["idx"] in self.fail_on:
+            return {"error": "invalid response", "retryable": False}
+
+        return [{"text": text, "type": 0, "start": 0}]
+
+    def get_annotator_id(self):
+        return "llm-stub"
+
+    def get_retry_policy(self):
+        return RetryPolicy(max_attempts=1)
+
+    def use_response_cache(self):
+        return False
+
+
+@pytest.fixture
+def campaign(tmp_path, monkeypatch):
+    monkeypatch.setattr(campaigns, "ANNOTATIONS_DIR", str(tmp_path))
+    monkeypatch.setattr(utils, "ANNOTATIONS_DIR", str(tmp_path))
+    monkeypatch.setattr(
+        annotation_index, "annotation_index", AnnotationIndex(tmp_path / "annotation_index.sqlite", tmp_path)
+    )
+
+    campaign_dir = tmp_path / "llm-eval-test"
+    os.makedirs(campaign_dir / "files")
+
+    db = pd.DataFrame(
+        {
+            "dataset": "stub",
+            "split": "test",
+            "setup_id": "setup",
+            "example_idx": range(5),
+            "annotator_id": "",
+            "status": ExampleStatus.FREE,
+            "start": "",
+            "end": "",
+        }
+    )
+    db.to_csv(campaign_dir / "db.csv", index=False)
+
+    with open(campaign_dir / "metadata.json", "w") as f:
+        json.dump(
+            {
+                "id": "llm-eval-test",
+                "source": "llm_eval",
+                "status": CampaignStatus.IDLE,
+                "config": {"extra_args": {"max_concurrency": 2}},
+            },
+            f,
+        )
+
+    return LLMCampaignEval(campaign_id="llm-eval-test")
+
+
+def run_campaign(campaign, model):
+    threads = {campaign.campaign_id: {"running": True}}
+    datasets = {"stub": StubDataset()}
+
+    return utils.run_llm_campaign("llm_eval", campaign.campaign_id, None, campaign, datasets, model, threads)
+
+
+def test_run_llm_campaign(campaign):
+    result = run_campaign(campaign, StubModel())
+
+    assert result["success"]
+    assert campaign.metadata["status"] == CampaignStatus.FINISHED
+
+    reloaded = LLMCampaignEval(campaign_id=campaign.campaign_id)
+    assert (reloaded.db["status"] == ExampleStatus.FINISHED).all()
+
+    finished = reloaded.get_finished_examples()
+    assert sorted(example["example_idx"] for example in finished) == list(range(5))
+    assert all(example["annotations"][0]["text"] == f"output {example['example_idx']}" for example in finished)
+
+
+def test_run_llm_campaign_records_errors(campaign):
+    result = run_campaign(campaign, StubModel(fail_on={1, 3}))
+
+    assert result["success"]
+    assert campaign.metadata["status"] == CampaignStatus.IDLE
+
+    reloaded = LLMCampaignEval(campaign_id=campaign.campaign_id)
+    failed = reloaded.db[reloaded.db["status"] == ExampleStatus.ERROR]
+
+    assert sorted(failed["example_idx"]) == [1, 3]
+    assert (failed["error"] == "invalid response").all()
+    assert reloaded.get_finished_count() == 3
+
+
+def test_run_llm_campaign_stopped(campaign):
+    threads = {campaign.campaign_id: {"running": False}}
+    datasets = {"stub": StubDataset()}
+
+    result = utils.run_llm_campaign("llm_eval", campaign.campaign_id, None, campaign, datasets, StubModel(), threads)
+
+    assert result["success"]
+    assert "stopped" in result["final_message"]
+    assert campaign.metadata["status"] == CampaignStatus.IDLE
+
+
+def test_overview_with_numeric_setup_id(campaign):
+    # an all-digit setup id is read from `db.csv` as int, but it can be stored as a string in the annotations
+    db = campaign.db
+    db["setup_id"] = "2024"
+    campaign.update_db(db)
+
+    with open(os.path.join(campaign.dir, "files", "annotations.jsonl"), "w") as f:
+        for example_idx in range(5):
+            record = {"dataset": "stub", "split": "test", "setup_id": "2024", "example_idx": example_idx}
+            f.write(json.dumps({**record, "annotations": [{"text": "output", "type": 0, "start": 0}]}) + "\n")
+
+    overview = LLMCampaignEval(campaign_id=campaign.campaign_id).get_overview()
+
+    assert [row["setup_id"] for row in overview] == [2024] * 5
+    assert all(row["output"] != LLMCampaignEval.OUTPUT_DEFAULT for row in overview)
+
+
+def test_run_llm_campaign_missing_dataset(campaign):
+    threads = {campaign.campaign_id: {"running": True}}
+
+    result = utils.run_llm_campaign("llm_eval", campaign.campaign_id, None, campaign, {}, StubModel(), threads)
+
+    assert not result["success"]
+    assert "stub" in result["error"]
+    assert campaign.metadata["status"] == CampaignStatus.IDLE
+
+
+def test_run_llm_campaign_empty_extra_args(campaign):
+    # the fields of `extra_args` left empty in the web interface are saved as empty strings
+    campaign.metadata["config"]["extra_args"] = {"max_concurrency": "", "circuit_breaker_threshold": ""}
+
+    result = run_campaign(campaign, StubModel())
+
+    assert result["success"]
+    assert campaign.metadata["status"] == CampaignStatus.FINISHED